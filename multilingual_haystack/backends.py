@@ -1,29 +1,75 @@
 # based on http://anthony-tresontani.github.io/Django/2012/09/20/multilingual-search/
+import copy
 import re
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from django import db
 from django.conf import settings
 from django.utils import translation
 from haystack import connections
 from haystack.backends import BaseEngine, BaseSearchBackend, BaseSearchQuery
 from haystack.constants import DEFAULT_ALIAS
+from haystack.indexes import SearchIndex
 from haystack.utils.loading import load_backend
 
 class MultilingualSearchBackend(BaseSearchBackend):
-    def _operate(self, method_name, *args, **kwargs):
-        backends = set()
+    """
+    Dispatches updates to the per-language backends. The languages are
+    processed concurrently in a thread pool; each thread prepares the
+    documents under its own translation, with its own copy of the
+    search index, and pushes them to its backend.
+    Set INDEX_WORKERS in the connection options to limit the number of
+    threads (1 processes the languages serially).
+    """
+    def __init__(self, connection_alias, **connection_options):
+        super(MultilingualSearchBackend, self).__init__(connection_alias, **connection_options)
+        self.index_workers = connection_options.get('INDEX_WORKERS', len(settings.LANGUAGES))
+
+    def _get_language_backends(self):
+        backends = OrderedDict()
         for language, _ in settings.LANGUAGES:
             using = '%s-%s' % (self.connection_alias, language)
             # Ensure each backend is called only once
-            if using in backends:
-                continue
-            else:
-                backends.add(using)
-            with translation.override(language):
-                backend = connections[using].get_backend()
-                fn = getattr(backend.parent_class, method_name)
-                fn(backend, *args, **kwargs)
+            if using not in backends:
+                backends[using] = language
+        return backends
 
-    def update(self, *args, **kwargs):
-        self._operate('update', *args, **kwargs)
+    def _operate_language(self, using, language, method_name, *args, **kwargs):
+        # SearchIndex.prepare() keeps the document being prepared on the
+        # index instance, so each language works on its own copy.
+        args = [copy.copy(arg) if isinstance(arg, SearchIndex) else arg for arg in args]
+        with translation.override(language):
+            backend = connections[using].get_backend()
+            fn = getattr(backend.parent_class, method_name)
+            return fn(backend, *args, **kwargs)
+
+    def _operate_in_thread(self, *args, **kwargs):
+        try:
+            return self._operate_language(*args, **kwargs)
+        finally:
+            # Worker threads open their own database connections
+            for conn in db.connections.all():
+                conn.close()
+
+    def _operate(self, method_name, *args, **kwargs):
+        backends = self._get_language_backends()
+        if self.index_workers <= 1 or len(backends) < 2:
+            for using, language in backends.items():
+                self._operate_language(using, language, method_name, *args, **kwargs)
+            return
+
+        with ThreadPoolExecutor(max_workers=self.index_workers) as executor:
+            futures = [executor.submit(self._operate_in_thread, using, language,
+                                       method_name, *args, **kwargs)
+                       for using, language in backends.items()]
+            # Re-raise any exceptions in the caller
+            for future in futures:
+                future.result()
+
+    def update(self, index, iterable, *args, **kwargs):
+        # Evaluate querysets once instead of once per language
+        self._operate('update', index, list(iterable), *args, **kwargs)
 
     def remove(self, *args, **kwargs):
         self._operate('remove', *args, **kwargs)
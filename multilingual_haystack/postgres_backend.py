@@ -0,0 +1,512 @@
+"""
+PostgreSQL full-text search backend for Haystack.
+
+Documents are stored in one table per connection. The prepared fields
+are kept in a jsonb column, the text fields are indexed in a weighted
+tsvector column using the text search configuration of the connection's
+language, and the edge n-gram (autosuggest) fields are kept in a text
+column with a trigram index. Requires PostgreSQL 9.5 with PostGIS.
+
+Configure it as the BASE_ENGINE of a LanguageSearchEngine connection:
+
+    'default-fi': {
+        'ENGINE': 'multilingual_haystack.backends.LanguageSearchEngine',
+        'BASE_ENGINE': 'multilingual_haystack.postgres_backend.PostgresSearchEngine',
+        'TABLE_NAME': 'search_document_fi',
+    },
+
+The text search configuration defaults to the one matching the language
+suffix of the connection name and can be set with TEXT_SEARCH_CONFIG.
+"""
+import json
+import math
+import re
+
+import psycopg2.extras
+from django.contrib.gis.measure import Distance
+from django.db import connections as db_connections, transaction
+from haystack import connections
+from haystack.backends import BaseEngine, BaseSearchBackend, BaseSearchQuery, SearchNode, log_query
+from haystack.constants import DJANGO_CT, DJANGO_ID, ID
+from haystack.exceptions import SearchBackendError
+from haystack.models import SearchResult
+from haystack.utils import get_identifier, get_model_ct
+
+TEXT_SEARCH_CONFIGS = {
+    'fi': 'finnish',
+    'sv': 'swedish',
+    'en': 'english',
+}
+
+TEXT_FIELD_TYPES = ('string', 'edge_ngram', 'ngram')
+SUGGEST_FIELD_TYPES = ('edge_ngram', 'ngram')
+NUMERIC_FIELD_TYPES = ('integer', 'float', 'decimal')
+
+DISTANCE_RE = re.compile(r'^\s*([0-9.]+)\s*(km|m)?\s*$')
+
+
+def parse_distance(value):
+    """
+    Parse an Elasticsearch style distance ('5km', '500m', 500) into meters.
+    """
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = DISTANCE_RE.match(value)
+    if not match:
+        raise ValueError("Invalid distance: %s" % value)
+    meters = float(match.group(1))
+    if match.group(2) == 'km':
+        meters *= 1000
+    return meters
+
+
+def parse_geo_point(value):
+    """
+    Parse an Elasticsearch style geo point into a (lon, lat) tuple.
+    """
+    if isinstance(value, dict):
+        return float(value['lon']), float(value['lat'])
+    if isinstance(value, (list, tuple)):
+        return float(value[0]), float(value[1])
+    lat, lon = value.split(',')
+    return float(lon), float(lat)
+
+
+class PostgresSearchBackend(BaseSearchBackend):
+    def __init__(self, connection_alias, **connection_options):
+        super(PostgresSearchBackend, self).__init__(connection_alias, **connection_options)
+        self.database = connection_options.get('DATABASE', 'default')
+        default_table = 'search_document_%s' % re.sub(r'\W', '_', connection_alias)
+        self.table_name = connection_options.get('TABLE_NAME', default_table)
+        language = connection_alias.rsplit('-', 1)[-1]
+        self.text_search_config = connection_options.get(
+            'TEXT_SEARCH_CONFIG', TEXT_SEARCH_CONFIGS.get(language, 'simple'))
+        self.setup_complete = False
+
+    def _cursor(self):
+        return db_connections[self.database].cursor()
+
+    def get_fields(self):
+        return connections[self.connection_alias].get_unified_index().all_searchfields()
+
+    def setup(self):
+        table = self.table_name
+        with transaction.atomic(using=self.database):
+            cursor = self._cursor()
+            cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS {table} ("
+                "id varchar(255) PRIMARY KEY, "
+                "django_ct varchar(100) NOT NULL, "
+                "django_id varchar(100) NOT NULL, "
+                "data jsonb NOT NULL, "
+                "content tsvector NOT NULL, "
+                "suggest text NOT NULL DEFAULT '', "
+                "location geography(Point, 4326))".format(table=table))
+            cursor.execute("CREATE INDEX IF NOT EXISTS {table}_ct ON {table} (django_ct)".format(table=table))
+            cursor.execute("CREATE INDEX IF NOT EXISTS {table}_content ON {table} "
+                           "USING gin (content)".format(table=table))
+            cursor.execute("CREATE INDEX IF NOT EXISTS {table}_suggest ON {table} "
+                           "USING gin (suggest gin_trgm_ops)".format(table=table))
+            cursor.execute("CREATE INDEX IF NOT EXISTS {table}_location ON {table} "
+                           "USING gist (location)".format(table=table))
+        self.setup_complete = True
+
+    def _build_row(self, index, obj):
+        doc = index.full_prepare(obj)
+        fields = self.get_fields()
+
+        weighted_text = {'A': [], 'B': []}
+        suggest = []
+        location = None
+        for name, value in doc.items():
+            field = fields.get(name)
+            if field is None or value in (None, ''):
+                continue
+            if field.field_type == 'location':
+                if location is None:
+                    lat, lon = [float(x) for x in value.split(',')]
+                    location = 'SRID=4326;POINT(%s %s)' % (lon, lat)
+                continue
+            if field.is_multivalued:
+                value = ' '.join(str(x) for x in value)
+            if field.field_type in SUGGEST_FIELD_TYPES:
+                suggest.append(str(value).lower())
+            elif field.field_type in TEXT_FIELD_TYPES:
+                weighted_text['A' if field.document else 'B'].append(str(value))
+
+        data = {k: v for k, v in doc.items() if k not in (ID, DJANGO_CT, DJANGO_ID)}
+        return (doc[ID], doc[DJANGO_CT], str(doc[DJANGO_ID]),
+                psycopg2.extras.Json(data, dumps=lambda x: json.dumps(x, default=str)),
+                self.text_search_config, ' '.join(weighted_text['A']),
+                self.text_search_config, ' '.join(weighted_text['B']),
+                ' '.join(suggest), location)
+
+    def update(self, index, iterable, commit=True):
+        if not self.setup_complete:
+            self.setup()
+        rows = [self._build_row(index, obj) for obj in iterable]
+        if not rows:
+            return
+        with transaction.atomic(using=self.database):
+            cursor = self._cursor()
+            cursor.executemany(
+                "INSERT INTO {table} (id, django_ct, django_id, data, content, suggest, location) "
+                "VALUES (%s, %s, %s, %s, "
+                "setweight(to_tsvector(%s::regconfig, %s), 'A') || "
+                "setweight(to_tsvector(%s::regconfig, %s), 'B'), %s, %s) "
+                "ON CONFLICT (id) DO UPDATE SET data = EXCLUDED.data, content = EXCLUDED.content, "
+                "suggest = EXCLUDED.suggest, location = EXCLUDED.location".format(table=self.table_name),
+                rows)
+
+    def remove(self, obj_or_string, commit=True):
+        if not self.setup_complete:
+            self.setup()
+        cursor = self._cursor()
+        cursor.execute("DELETE FROM {table} WHERE id = %s".format(table=self.table_name),
+                       [get_identifier(obj_or_string)])
+
+    def clear(self, models=[], commit=True):
+        if not self.setup_complete:
+            self.setup()
+        cursor = self._cursor()
+        if models:
+            cursor.execute("DELETE FROM {table} WHERE django_ct = ANY(%s)".format(table=self.table_name),
+                           [[get_model_ct(model) for model in models]])
+        else:
+            cursor.execute("DELETE FROM {table}".format(table=self.table_name))
+
+    def _check_field_name(self, name):
+        """
+        Field names end up in the SQL, so only the fields of the unified
+        index are accepted.
+        """
+        if name not in self.get_fields():
+            raise SearchBackendError("'%s' is not a field of the search index" % name)
+        return name
+
+    def _build_facets(self, facets, where, params):
+        fields = self.get_fields()
+        results = {}
+        cursor = self._cursor()
+        for name, options in facets.items():
+            if name == DJANGO_CT:
+                value_sql = "django_ct"
+            elif fields[self._check_field_name(name)].is_multivalued:
+                value_sql = "jsonb_array_elements_text(data->'%s')" % name
+            else:
+                value_sql = "data->>'%s'" % name
+            sql = ("SELECT value, count(*) FROM (SELECT {value} AS value FROM {table} WHERE {where}) v "
+                   "WHERE value IS NOT NULL GROUP BY value ORDER BY count(*) DESC, value".format(
+                       value=value_sql, table=self.table_name, where=where))
+            facet_params = list(params)
+            if options.get('size'):
+                sql += " LIMIT %s"
+                facet_params.append(int(options['size']))
+            cursor.execute(sql, facet_params)
+            results[name] = [tuple(row) for row in cursor.fetchall()]
+        return results
+
+    @log_query
+    def search(self, query, start_offset=0, end_offset=None, models=None, facets=None,
+               within=None, dwithin=None, distance_point=None, sort_by=None,
+               decay_functions=None, result_class=None, **kwargs):
+        if not isinstance(query, dict):
+            raise SearchBackendError("PostgresSearchBackend does not support raw queries")
+        if kwargs.get('narrow_queries'):
+            raise SearchBackendError("PostgresSearchBackend does not support narrow()")
+        if not self.setup_complete:
+            self.setup()
+        if result_class is None:
+            result_class = SearchResult
+
+        where, params = query['where'], list(query['params'])
+        score, score_params = query['score'], list(query['score_params'])
+
+        conditions, condition_params = [where], params
+        if models:
+            conditions.append("django_ct = ANY(%s)")
+            condition_params.append([get_model_ct(model) for model in models])
+        if dwithin:
+            lng, lat = dwithin['point'].get_coords()
+            conditions.append("ST_DWithin(location, ST_SetSRID(ST_MakePoint(%s, %s), 4326)::geography, %s)")
+            condition_params += [lng, lat, dwithin['distance'].m]
+        if within:
+            min_lng, min_lat = within['point_1'].get_coords()
+            max_lng, max_lat = within['point_2'].get_coords()
+            conditions.append("location::geometry && ST_MakeEnvelope(%s, %s, %s, %s, 4326)")
+            condition_params += [min_lng, min_lat, max_lng, max_lat]
+        where_sql = ' AND '.join('(%s)' % x for x in conditions)
+
+        for decay in decay_functions or []:
+            decay_sql, decay_params = self._build_decay(decay)
+            score = "(%s) * %s" % (score, decay_sql)
+            score_params += decay_params
+
+        columns = ["django_ct", "django_id", "data", "(%s) AS score" % score, "count(*) OVER () AS hits"]
+        column_params = score_params
+        if distance_point:
+            lng, lat = distance_point['point'].get_coords()
+            columns.append("ST_Distance(location, ST_SetSRID(ST_MakePoint(%s, %s), 4326)::geography) AS distance")
+            column_params = column_params + [lng, lat]
+        else:
+            columns.append("NULL AS distance")
+
+        order = ["score DESC", "id"]
+        if sort_by:
+            order = [self._build_order(field, distance_point is not None) for field in sort_by] + ["id"]
+
+        sql = "SELECT {columns} FROM {table} WHERE {where} ORDER BY {order} OFFSET %s".format(
+            columns=', '.join(columns), table=self.table_name, where=where_sql, order=', '.join(order))
+        sql_params = column_params + condition_params + [start_offset]
+        if end_offset is not None:
+            sql += " LIMIT %s"
+            sql_params.append(end_offset - start_offset)
+
+        cursor = self._cursor()
+        cursor.execute(sql, sql_params)
+        rows = cursor.fetchall()
+
+        if rows:
+            hits = rows[0][4]
+        else:
+            cursor.execute("SELECT count(*) FROM {table} WHERE {where}".format(
+                table=self.table_name, where=where_sql), condition_params)
+            hits = cursor.fetchone()[0]
+
+        ret = {'results': self._build_results(rows, result_class, distance_point), 'hits': hits}
+        if facets:
+            ret['facets'] = {'fields': self._build_facets(facets, where_sql, condition_params)}
+        return ret
+
+    def _build_results(self, rows, result_class, distance_point=None):
+        results = []
+        for django_ct, django_id, data, row_score, _, distance in rows:
+            app_label, model_name = django_ct.split('.')
+            extra = {str(k): v for k, v in data.items()}
+            if distance_point:
+                extra['_point_of_origin'] = distance_point
+                extra['_distance'] = Distance(m=distance) if distance is not None else None
+            results.append(result_class(app_label, model_name, django_id, row_score, **extra))
+        return results
+
+    def _build_order(self, field, has_distance):
+        descending = field.startswith('-')
+        field = field.lstrip('-')
+        if field == 'distance' and has_distance:
+            sql = "distance"
+        elif field == 'score':
+            sql = "score"
+        else:
+            sql = "data->>'%s'" % self._check_field_name(field)
+        return "%s %s" % (sql, 'DESC' if descending else 'ASC')
+
+    def _build_decay(self, function_dict):
+        """
+        Translate an Elasticsearch decay function on a location field
+        into an SQL multiplier for the score.
+        """
+        (function, field_options), = function_dict.items()
+        (field_name, options), = field_options.items()
+        field = self.get_fields().get(field_name)
+        if field is None or field.field_type != 'location':
+            raise SearchBackendError("PostgresSearchBackend only supports decay functions "
+                                     "on location fields, not on '%s'" % field_name)
+
+        lng, lat = parse_geo_point(options['origin'])
+        scale = parse_distance(options['scale'])
+        offset = parse_distance(options.get('offset', 0))
+        decay = float(options.get('decay', 0.5))
+
+        distance = ("GREATEST(ST_Distance(location, ST_SetSRID(ST_MakePoint(%s, %s), 4326)::geography) "
+                    "- %s, 0)")
+        params = [lng, lat, offset]
+        if function == 'gauss':
+            sigma_sq = -scale ** 2 / (2 * math.log(decay))
+            sql = "exp(-(%s) ^ 2 / %%s)" % distance
+            params.append(2 * sigma_sq)
+        elif function == 'exp':
+            sql = "exp(%%s * (%s))" % distance
+            params = [math.log(decay) / scale] + params
+        elif function == 'linear':
+            s = scale / (1 - decay)
+            sql = "GREATEST((%%s - (%s)) / %%s, 0)" % distance
+            params = [s] + params + [s]
+        else:
+            raise SearchBackendError("Unknown decay function '%s'" % function)
+        # Documents without a location are not affected
+        return "COALESCE(%s, 1)" % sql, params
+
+    def prep_value(self, db_field, value):
+        return value
+
+    @log_query
+    def more_like_this(self, model_instance, additional_query_string=None, start_offset=0,
+                       end_offset=None, models=None, limit_to_registered_models=None,
+                       result_class=None, **kwargs):
+        """
+        Find the documents sharing words with the document of
+        `model_instance`, ranked by how many of its words they contain.
+        """
+        if not self.setup_complete:
+            self.setup()
+        if result_class is None:
+            result_class = SearchResult
+        identifier = get_identifier(model_instance)
+
+        # Any of the (already normalized) lexemes of the source document
+        source_sql = ("SELECT to_tsquery('simple', replace(strip(content)::text, ' ', ' | ')) AS q "
+                      "FROM {table} WHERE id = %s".format(table=self.table_name))
+        conditions = ["t.id <> %s", "t.content @@ source.q"]
+        params = [identifier]
+        if models:
+            conditions.append("t.django_ct = ANY(%s)")
+            params.append([get_model_ct(model) for model in models])
+        if isinstance(additional_query_string, dict):
+            # The filters of the SearchQuerySet, built by PostgresSearchQuery
+            conditions.append(additional_query_string['where'])
+            params += additional_query_string['params']
+        elif additional_query_string:
+            conditions.append("t.content @@ plainto_tsquery(%s::regconfig, %s)")
+            params += [self.text_search_config, additional_query_string]
+
+        sql = ("WITH source AS ({source}) "
+               "SELECT t.django_ct, t.django_id, t.data, ts_rank(t.content, source.q) AS score, "
+               "count(*) OVER () AS hits, NULL AS distance "
+               "FROM {table} t, source WHERE {where} ORDER BY score DESC, t.id OFFSET %s".format(
+                   source=source_sql, table=self.table_name, where=' AND '.join(conditions)))
+        sql_params = [identifier] + params + [start_offset]
+        if end_offset is not None:
+            sql += " LIMIT %s"
+            sql_params.append(end_offset - start_offset)
+
+        cursor = self._cursor()
+        cursor.execute(sql, sql_params)
+        rows = cursor.fetchall()
+        hits = rows[0][4] if rows else 0
+        return {'results': self._build_results(rows, result_class), 'hits': hits}
+
+
+class PostgresSearchQuery(BaseSearchQuery):
+    """
+    Compiles the query filter into an SQL condition and a score
+    expression for PostgresSearchBackend.
+    """
+    def __init__(self, **kwargs):
+        super(PostgresSearchQuery, self).__init__(**kwargs)
+        self.decay_functions = []
+
+    def add_decay_function(self, function_dict):
+        self.decay_functions.append(function_dict)
+
+    def _clone(self, **kwargs):
+        clone = super(PostgresSearchQuery, self)._clone(**kwargs)
+        clone.decay_functions = self.decay_functions[:]
+        return clone
+
+    def build_params(self, *args, **kwargs):
+        search_kwargs = super(PostgresSearchQuery, self).build_params(*args, **kwargs)
+        if self.decay_functions:
+            search_kwargs['decay_functions'] = self.decay_functions
+        return search_kwargs
+
+    def build_query(self):
+        if self.boost:
+            raise SearchBackendError("PostgresSearchBackend does not support boost()")
+        self._fields = connections[self._using].get_unified_index().all_searchfields()
+        self._config = self.backend.text_search_config
+        where, params, score, score_params = self._build_node(self.query_filter)
+        return {'where': where, 'params': params, 'score': score, 'score_params': score_params}
+
+    def _build_node(self, node):
+        parts = []
+        for child in node.children:
+            if isinstance(child, SearchNode):
+                if not child.children:
+                    continue
+                parts.append(self._build_node(child))
+            else:
+                expression, value = child
+                field, filter_type = node.split_expression(expression)
+                parts.append(self._build_lookup(field, filter_type, value))
+
+        if not parts:
+            return 'TRUE', [], '0', []
+        connector = ' OR ' if node.connector == SearchNode.OR else ' AND '
+        where = connector.join('(%s)' % p[0] for p in parts)
+        params = [x for p in parts for x in p[1]]
+        if node.negated:
+            where = 'NOT (%s)' % where
+        score = ' + '.join('(%s)' % p[2] for p in parts)
+        score_params = [x for p in parts for x in p[3]]
+        return where, params, score, score_params
+
+    def _build_lookup(self, field_name, filter_type, value):
+        """
+        Return (where, params, score, score_params) for a single lookup.
+        """
+        if hasattr(value, 'query_string'):
+            value = value.query_string
+        field = self._fields.get(field_name)
+        config = self._config
+
+        if field_name == DJANGO_CT:
+            if filter_type == 'in':
+                return "django_ct = ANY(%s)", [list(value)], '0', []
+            return "django_ct = %s", [value], '0', []
+
+        key = field_name.replace("'", "")
+        text = "data->>'%s'" % key
+        if field is not None and field.is_multivalued:
+            values = [str(x) for x in value] if filter_type == 'in' else [str(value)]
+            where = "EXISTS (SELECT 1 FROM jsonb_array_elements_text(data->'%s') e WHERE e = ANY(%%s))" % key
+            return where, [values], '0', []
+
+        field_type = field.field_type if field is not None else 'string'
+        boost = field.boost if field is not None else 1.0
+        if filter_type == 'contains' and field_type in SUGGEST_FIELD_TYPES:
+            # Match the beginning of any word
+            where = "suggest ~ %s"
+            params = ['(^|\\s)' + re.escape(str(value).lower())]
+            return where, params, "CASE WHEN %s THEN %%s ELSE 0 END" % where, params + [boost]
+        if filter_type == 'contains' and (field_name == 'content' or (field is not None and field.document)):
+            where = "content @@ plainto_tsquery(%s::regconfig, %s)"
+            params = [config, str(value)]
+            score = "ts_rank(content, plainto_tsquery(%s::regconfig, %s)) * %s"
+            return where, params, score, params + [boost]
+        if filter_type == 'contains' and field_type == 'string':
+            # The indexed content column narrows down the rows to check
+            where = ("content @@ plainto_tsquery(%%s::regconfig, %%s) AND "
+                     "to_tsvector(%%s::regconfig, coalesce(%s, '')) @@ plainto_tsquery(%%s::regconfig, %%s)" % text)
+            params = [config, str(value), config, config, str(value)]
+            score = "ts_rank(content, plainto_tsquery(%s::regconfig, %s)) * %s"
+            return where, params, score, [config, str(value), boost]
+        if filter_type in ('exact', 'contains'):
+            where = "lower(%s) = lower(%%s)" % text
+            params = [str(value)]
+            return where, params, "CASE WHEN %s THEN %%s ELSE 0 END" % where, params + [boost]
+        if filter_type == 'startswith':
+            where = "%s LIKE %%s" % text
+            params = [str(value).replace('%', '\\%').replace('_', '\\_') + '%']
+            return where, params, '0', []
+        if filter_type == 'in':
+            return "%s = ANY(%%s)" % text, [[str(x) for x in value]], '0', []
+
+        if field_type in NUMERIC_FIELD_TYPES:
+            text = "(%s)::numeric" % text
+        operators = {'gt': '>', 'gte': '>=', 'lt': '<', 'lte': '<='}
+        if filter_type in operators:
+            return "%s %s %%s" % (text, operators[filter_type]), [value], '0', []
+        if filter_type == 'range':
+            start, end = value
+            return "%s BETWEEN %%s AND %%s" % text, [start, end], '0', []
+        raise SearchBackendError("PostgresSearchBackend does not support the filter %s__%s" % (
+            field_name, filter_type))
+
+    def matching_all_fragment(self):
+        return 'TRUE'
+
+
+class PostgresSearchEngine(BaseEngine):
+    backend = PostgresSearchBackend
+    query = PostgresSearchQuery
@@ -6,6 +6,7 @@ TIMESTAMP_FORMAT="+%Y-%m-%d %H:%M:%S"
 ROOT_PATH="$(cd "$(dirname "${BASH_SOURCE[0]}")/.." && pwd)"
 
 LOG_FILE="/tmp/smbackend-import-$(date "+%Y-%m-%d-%H-%M").log"
+CHANGESET_FILE="/tmp/smbackend-changeset-$(date "+%Y-%m-%d-%H-%M").json"
 
 if [ -f $ROOT_PATH/local_update_config ]; then
     $ROOT_PATH/local_update_config
@@ -17,18 +18,20 @@ echo --------------------------------- >> $LOG_FILE
 
 cd $ROOT_PATH
 
-nice python manage.py services_import --traceback --organizations --departments --services --units >> $LOG_FILE 2>&1
+nice python manage.py services_import --traceback --delta --changeset $CHANGESET_FILE --organizations --departments --services --units >> $LOG_FILE 2>&1
 if [ $? -ne 0 ]; then
     cat $LOG_FILE
     exit 1
 fi
 
-nice python manage.py update_index -a 1 >> $LOG_FILE 2>&1
+nice python manage.py update_index_changeset $CHANGESET_FILE >> $LOG_FILE 2>&1
 if [ $? -ne 0 ]; then
     cat $LOG_FILE
     exit 1
 fi
 
+rm -f $CHANGESET_FILE
+
 curl -X PURGE http://10.1.2.123/servicemap >> $LOG_FILE 2>&1
 if [ $? -ne 0 ]; then
     cat $LOG_FILE
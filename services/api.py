@@ -1,32 +1,55 @@
+import calendar
+import datetime
+import hashlib
 import json
 import re
+from collections import OrderedDict
+from operator import attrgetter, itemgetter
 
 from django.conf import settings
 from django.utils import translation
-from django.db.models import Q
+from django.db.models import Q, Prefetch, Max
 from django.contrib.gis.geos import Polygon, MultiPolygon, GeometryCollection, Point
 from django.contrib.gis.db.models.fields import GeometryField
 from django.contrib.gis.gdal import CoordTransform, SpatialReference
+from django.contrib.gis.measure import D
 from django.shortcuts import get_object_or_404
 from modeltranslation.translator import translator, NotRegistered
 from rest_framework import serializers, viewsets, generics
 from rest_framework.response import Response
 from rest_framework.exceptions import ParseError
-from django.core.exceptions import ValidationError
+from rest_framework.fields import SkipField
+from django.core.exceptions import ValidationError, FieldDoesNotExist
 from rest_framework.views import APIView
 
+from haystack import connections as haystack_connections
 from haystack.query import SearchQuerySet, SQ
 from haystack.inputs import AutoQuery
+from haystack.backends.simple_backend import SimpleSearchBackend
+from multilingual_haystack.custom_elasticsearch_search_backend import CustomEsSearchQuerySet
 
 from services.models import *
 from services.accessibility import RULES as accessibility_rules
+from services.service_tree import get_service_tree, ServiceNode
+from services.extension_translations import get_extension_translations
+from services.search_cache import search_cache
+from services.unit_cache import unit_cache, is_enabled as unit_cache_enabled
+from services.api_pagination import KeysetPagination
+from services.autosuggest import get_autosuggest_index
 from munigeo.models import *
 from munigeo import api as munigeo_api
 
 from rest_framework import renderers
 from rest_framework_jsonp.renderers import JSONPRenderer
-from django.template.loader import render_to_string
+from django.template.loader import render_to_string, get_template
+from django.http import StreamingHttpResponse, HttpResponseNotModified
+from django.utils.http import http_date, parse_http_date_safe, parse_etags, quote_etag
+from rest_framework.decorators import list_route
+from rest_framework.utils.encoders import JSONEncoder
+from services.importer.stream import iter_queryset_chunks
 from django.utils.module_loading import import_string
+from django.utils.cache import patch_vary_headers
+from django.utils.text import compress_sequence
 
 if settings.REST_FRAMEWORK and settings.REST_FRAMEWORK['DEFAULT_RENDERER_CLASSES']:
     DEFAULT_RENDERERS = [import_string(renderer_module) for renderer_module in settings.REST_FRAMEWORK['DEFAULT_RENDERER_CLASSES']]
@@ -176,10 +199,8 @@ register_view(DepartmentViewSet, 'department')
 
 
 def root_services(services):
-    tree_ids = set(s.tree_id for s in services)
-    return map(lambda x: x.id,
-               Service.objects.filter(level=0).filter(
-                   tree_id__in=tree_ids))
+    tree = get_service_tree()
+    return map(lambda x: tree.root_id(x.id) or x.get_root().id, services)
 
 class JSONAPISerializer(serializers.ModelSerializer):
     def __init__(self, *args, **kwargs):
@@ -221,6 +242,9 @@ class ServiceSerializer(TranslatedModelSerializer, MPTTModelSerializer, JSONAPIS
 
 
 class JSONAPIViewSetMixin:
+    # Model fields loaded even when not listed in only=
+    only_required_fields = []
+
     def initial(self, request, *args, **kwargs):
         ret = super(JSONAPIViewSetMixin, self).initial(request, *args, **kwargs)
 
@@ -252,6 +276,7 @@ class JSONAPIViewSetMixin:
             if 'parent' in fields:
                 fields.remove('parent')
                 fields.append('parent_id')
+            fields += self.only_required_fields
             queryset = queryset.only(*fields)
         return queryset
 
@@ -267,6 +292,119 @@ class JSONAPIViewSetMixin:
 class JSONAPIViewSet(JSONAPIViewSetMixin, viewsets.ReadOnlyModelViewSet):
     pass
 
+class ConditionalGetMixin(object):
+    """
+    Adds ETag and Last-Modified headers to list and detail responses and
+    answers conditional requests with 304 Not Modified before anything
+    is serialized. List validators come from the rows of the requested
+    page: their ids (so that deletions and reordering are noticed) and
+    the newest `modified_field` among them, plus what the pagination
+    adds to the response: the total count that the page number
+    paginator has already counted, or whether a keyset page has a next
+    page.
+    """
+    modified_field = None
+
+    def get_extra_validator_data(self):
+        """
+        Data besides the objects themselves that affects the response.
+        """
+        return {}
+
+    def get_pagination_validator_data(self):
+        paginator = self.paginator
+        if paginator is None or getattr(paginator, 'page', None) is None:
+            return {}
+        if isinstance(paginator, KeysetPagination):
+            return {'has_next': paginator.has_next}
+        # Also covers count and next changing when objects on other
+        # pages are added or deleted
+        return {'count': paginator.page.paginator.count}
+
+    def get_rows_validator_data(self, rows, get_id, get_modified):
+        times = [t for t in (get_modified(row) for row in rows) if t is not None]
+        data = self.get_extra_validator_data()
+        data.update(self.get_pagination_validator_data())
+        data.update(ids=[get_id(row) for row in rows],
+                    last_modified=max(times) if times else None)
+        return data
+
+    def get_object_validator_data(self, obj):
+        data = self.get_extra_validator_data()
+        data.update(id=obj.pk, last_modified=getattr(obj, self.modified_field))
+        return data
+
+    def get_validators(self, data):
+        times = [val for val in data.values() if isinstance(val, datetime.datetime)]
+        last_modified = max(times) if times else None
+        etag_data = [
+            self.request.get_full_path(),
+            self.request.accepted_media_type,
+            sorted((key, val.isoformat() if isinstance(val, datetime.datetime) else val)
+                   for key, val in data.items()),
+        ]
+        etag = hashlib.sha1(json.dumps(etag_data).encode('utf8')).hexdigest()
+        return quote_etag(etag), last_modified
+
+    def get_not_modified_response(self, validators):
+        etag, last_modified = validators
+        if_none_match = self.request.META.get('HTTP_IF_NONE_MATCH')
+        if_modified_since = self.request.META.get('HTTP_IF_MODIFIED_SINCE')
+        if if_none_match:
+            etags = parse_etags(if_none_match)
+            if '*' not in etags and etag not in [quote_etag(x) for x in etags]:
+                return None
+        elif if_modified_since and last_modified is not None:
+            since = parse_http_date_safe(if_modified_since)
+            if since is None or calendar.timegm(last_modified.utctimetuple()) > since:
+                return None
+        else:
+            return None
+        return HttpResponseNotModified()
+
+    def set_validator_headers(self, response, validators):
+        etag, last_modified = validators
+        if response.status_code in (200, 304):
+            response['ETag'] = etag
+            if last_modified is not None:
+                response['Last-Modified'] = http_date(calendar.timegm(last_modified.utctimetuple()))
+        return response
+
+    def respond_conditionally(self, validator_data, build_response):
+        """
+        Return 304 Not Modified if the client's validators match,
+        otherwise the response from `build_response()`.
+        """
+        validators = self.get_validators(validator_data)
+        response = self.get_not_modified_response(validators)
+        if response is None:
+            response = build_response()
+        return self.set_validator_headers(response, validators)
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        rows = page if page is not None else list(queryset)
+        validator_data = self.get_rows_validator_data(
+            rows, attrgetter('pk'), attrgetter(self.modified_field))
+
+        def build_response():
+            serializer = self.get_serializer(rows, many=True)
+            if page is not None:
+                return self.get_paginated_response(serializer.data)
+            return Response(serializer.data)
+        return self.respond_conditionally(validator_data, build_response)
+
+    def retrieve(self, request, *args, **kwargs):
+        obj = self.get_object()
+        return self.respond_conditionally(self.get_object_validator_data(obj),
+                                          lambda: self.retrieve_object(obj))
+
+    def retrieve_object(self, obj):
+        serializer = self.get_serializer(obj)
+        return Response(serializer.data)
+
+
 class UnitConnectionSerializer(TranslatedModelSerializer, serializers.ModelSerializer):
     class Meta:
         model = UnitConnection
@@ -293,10 +431,16 @@ class UnitIdentifierSerializer(serializers.ModelSerializer):
         exclude = ['unit', 'id']
 
 
-class ServiceViewSet(JSONAPIViewSet, viewsets.ReadOnlyModelViewSet):
+class ServiceViewSet(ConditionalGetMixin, JSONAPIViewSet, viewsets.ReadOnlyModelViewSet):
     queryset = Service.objects.all()
     serializer_class = ServiceSerializer
     filter_fields = ['level', 'parent']
+    modified_field = 'last_modified_time'
+    only_required_fields = ['last_modified_time']
+
+    def get_extra_validator_data(self):
+        # Roots come from the service tree
+        return {'service_tree': get_service_tree().generation}
 
     def get_queryset(self):
         queryset = super(ServiceViewSet, self).get_queryset()
@@ -311,6 +455,85 @@ class ServiceViewSet(JSONAPIViewSet, viewsets.ReadOnlyModelViewSet):
 
 register_view(ServiceViewSet, 'service')
 
+# Fields that need their own get_attribute() (e.g. the pk-only
+# optimization of related fields)
+RELATIONAL_FIELD_TYPES = (serializers.RelatedField, serializers.ManyRelatedField,
+                          serializers.BaseSerializer)
+
+# Unit relations UnitSerializer expands with include=
+UNIT_INCLUDE_RELATIONS = ('department', 'municipality', 'services',
+                          'accessibility_properties', 'connections')
+
+
+class UnitSerializationPlan(object):
+    """
+    Everything about serializing units that depends only on the request
+    (the fields left after only=, the translated and geometry fields,
+    include= and geometry=) is resolved once per serializer. Serializing
+    a unit is then a flat loop over precomputed getters that produces
+    the same output as the generic serializer chain.
+    """
+    def __init__(self, serializer):
+        context = serializer.context
+        self.srs = context.get('srs', munigeo_api.DEFAULT_SRS)
+        self.include_fields = context.get('include', [])
+        self.has_request = 'request' in context
+        self.include_geometry = False
+        if self.has_request:
+            qparams = context['request'].query_params
+            self.include_geometry = qparams.get('geometry', '').lower() in ('true', '1')
+
+        translated_fields = set(serializer.translated_fields)
+        self.steps = []
+        for field in serializer.fields.values():
+            if field.write_only:
+                continue
+            name = field.field_name
+            if name in translated_fields:
+                attrs = [(lang, '%s_%s' % (name, lang)) for lang in LANGUAGES]
+                self.steps.append((name, self._translated_getter(attrs), None))
+            elif len(field.source_attrs) == 1 and not isinstance(field, RELATIONAL_FIELD_TYPES):
+                self.steps.append((name, attrgetter(field.source_attrs[0]), field.to_representation))
+            else:
+                self.steps.append((name, field, None))
+
+        # Geometry is dropped from the output unless geometry= is given,
+        # so it is not converted at all in that case.
+        self.geo_fields = [name for name in serializer.geo_fields
+                           if name != 'geometry' or self.include_geometry or not self.has_request]
+
+    @staticmethod
+    def _translated_getter(attrs):
+        def get(obj):
+            d = {}
+            for lang, attr in attrs:
+                val = getattr(obj, attr, None)
+                if val is not None:
+                    d[lang] = val
+            return d or None
+        return get
+
+    def serialize_fields(self, obj):
+        ret = OrderedDict()
+        for name, getter, convert in self.steps:
+            if isinstance(getter, serializers.Field):
+                try:
+                    value = getter.get_attribute(obj)
+                except SkipField:
+                    continue
+                convert = getter.to_representation
+            else:
+                value = getter(obj)
+            if value is None or convert is None:
+                ret[name] = value
+            else:
+                ret[name] = convert(value)
+        for name in self.geo_fields:
+            val = getattr(obj, name)
+            ret[name] = munigeo_api.geom_to_json(val, self.srs) if val is not None else None
+        return ret
+
+
 class UnitSerializer(TranslatedModelSerializer, MPTTModelSerializer,
                      munigeo_api.GeoModelSerializer, JSONAPISerializer):
     connections = UnitConnectionSerializer(many=True)
@@ -331,26 +554,35 @@ class UnitSerializer(TranslatedModelSerializer, MPTTModelSerializer,
     def handle_extension_translations(self, extensions):
         if extensions == None or len(extensions) == 0:
             return extensions
+        table = get_extension_translations()
         result = {}
         for key, value in extensions.items():
-            translations = {}
             if value == None or value == 'None':
                 result[key] = None
                 continue
-            for lang in LANGUAGES:
-                with translation.override(lang):
-                    translated_value = translation.ugettext(value)
-                    if translated_value != value:
-                        translations[lang] = translated_value
-                    translated_value = None
+            translations = table.translate(value)
             if len(translations) > 0:
-                result[key] = translations
+                result[key] = dict(translations)
             else:
                 result[key] = value
         return result
 
+    # Serialize through a UnitSerializationPlan instead of the generic
+    # serializer machinery
+    use_plan = True
+
+    @property
+    def plan(self):
+        if not hasattr(self, '_plan'):
+            self._plan = UnitSerializationPlan(self)
+        return self._plan
+
     def to_representation(self, obj):
-        ret = super(UnitSerializer, self).to_representation(obj)
+        plan = self.plan
+        if self.use_plan:
+            ret = plan.serialize_fields(obj)
+        else:
+            ret = super(UnitSerializer, self).to_representation(obj)
         if hasattr(obj, 'distance') and obj.distance:
             ret['distance'] = obj.distance.m
 
@@ -363,12 +595,9 @@ class UnitSerializer(TranslatedModelSerializer, MPTTModelSerializer,
             ret['keywords'] = kw_dict
 
         if 'root_services' in ret:
-            if obj.root_services == None or obj.root_services == '':
-                ret['root_services'] = None
-            else:
-                ret['root_services'] = [int(x) for x in obj.root_services.split(',')]
+            ret['root_services'] = parse_root_services(obj.root_services)
 
-        include_fields = self.context.get('include', [])
+        include_fields = plan.include_fields
         if 'department' in include_fields:
             dep_json = DepartmentSerializer(obj.department, context=self.context).data
             ret['department'] = dep_json
@@ -377,16 +606,22 @@ class UnitSerializer(TranslatedModelSerializer, MPTTModelSerializer,
             ret['municipality'] = muni_json
         # Not using actual serializer instances below is a performance optimization.
         if 'services' in include_fields:
+            tree = get_service_tree()
             services_json = []
             for s in obj.services.all():
-                name = {}
-                for lang in LANGUAGES:
-                    name[lang] = getattr(s, 'name_{0}'.format(lang))
-                data = {'id': s.id, 'name': name, 'root': s.get_root().id}
-                if s.identical_to:
-                    data['identical_to'] = getattr(s.identical_to, 'id', None)
-                if s.level is not None:
-                    data['level'] = s.level
+                node = tree.get(s.id)
+                if node is None:
+                    # Service imported after the snapshot was taken
+                    name = {}
+                    for lang in LANGUAGES:
+                        name[lang] = getattr(s, 'name_{0}'.format(lang))
+                    node = ServiceNode(s.id, s.parent_id, s.get_root().id, s.level,
+                                       name, s.identical_to_id)
+                data = {'id': node.id, 'name': node.name, 'root': node.root_id}
+                if node.identical_to_id:
+                    data['identical_to'] = node.identical_to_id
+                if node.level is not None:
+                    data['level'] = node.level
                 services_json.append(data)
             ret['services'] = services_json
         if 'accessibility_properties' in include_fields:
@@ -397,13 +632,12 @@ class UnitSerializer(TranslatedModelSerializer, MPTTModelSerializer,
         if 'connections' in include_fields:
             ret['connections'] = UnitConnectionSerializer(obj.connections, many=True).data
 
-        if not 'request' in self.context:
+        if not plan.has_request:
             return ret
-        qparams = self.context['request'].query_params
-        if qparams.get('geometry', '').lower() in ('true', '1'):
+        if plan.include_geometry:
             geom = obj.geometry # TODO: different geom types
             if geom and obj.geometry != obj.location:
-                ret['geometry'] = munigeo_api.geom_to_json(geom, self.srs)
+                ret['geometry'] = munigeo_api.geom_to_json(geom, plan.srs)
         elif 'geometry' in ret:
             del ret['geometry']
 
@@ -417,10 +651,113 @@ class UnitSerializer(TranslatedModelSerializer, MPTTModelSerializer,
         model = Unit
         exclude = [
             'connection_hash', 'accessibility_property_hash',
-            'identifier_hash',
+            'identifier_hash', 'content_hash',
         ]
 
 
+class UnitValuesPlan(object):
+    """
+    Serializes units straight from values_list() rows when every field
+    asked for with only= maps to columns of the unit table. Produces the
+    same output as UnitSerializer without instantiating models or going
+    through the serializer fields. Use `for_serializer()`, which returns
+    None when the fields need the full serializer.
+    """
+    def __init__(self, columns, steps):
+        self.columns = columns
+        # Keyset pagination and the response validators read these
+        self.id_index = columns.index('id')
+        self.modified_index = columns.index('origin_last_modified_time')
+        # List of (output name, row index or indices, converter)
+        self.steps = steps
+
+    @classmethod
+    def for_serializer(cls, serializer):
+        plan = serializer.plan
+        if plan.include_fields:
+            return None
+        translated_fields = set(serializer.translated_fields)
+        model_opts = serializer.Meta.model._meta
+        columns = []
+        steps = []
+
+        def add_columns(*names):
+            start = len(columns)
+            columns.extend(names)
+            return start if len(names) == 1 else list(range(start, len(columns)))
+
+        for name in list(serializer.fields.keys()) + serializer.geo_fields:
+            if name in translated_fields:
+                attrs = ['%s_%s' % (name, lang) for lang in LANGUAGES]
+                steps.append((name, add_columns(*attrs), cls._translated))
+                continue
+            try:
+                model_field = model_opts.get_field(name)
+            except FieldDoesNotExist:
+                return None
+            if not model_field.concrete or model_field.many_to_many:
+                return None
+            if name == 'data_source':
+                # Never included in responses
+                continue
+            if name == 'geometry':
+                if plan.include_geometry:
+                    return None
+                continue
+
+            if name in serializer.geo_fields:
+                srs = plan.srs
+                convert = lambda val, srs=srs: munigeo_api.geom_to_json(val, srs)
+            elif model_field.is_relation:
+                convert = None
+            elif name == 'root_services':
+                convert = parse_root_services
+            elif name == 'extensions':
+                field = serializer.fields[name]
+                convert = lambda val, field=field: serializer.handle_extension_translations(
+                    field.to_representation(val))
+            elif isinstance(serializer.fields[name], serializers.ModelField):
+                # Converts model instances, not column values
+                return None
+            else:
+                convert = serializer.fields[name].to_representation
+            steps.append((name, add_columns(name), convert))
+        for name in ('id', 'origin_last_modified_time'):
+            if name not in columns:
+                add_columns(name)
+        return cls(columns, steps)
+
+    @staticmethod
+    def _translated(values):
+        d = {}
+        for lang, val in zip(LANGUAGES, values):
+            if val is not None:
+                d[lang] = val
+        return d or None
+
+    def get_queryset(self, queryset):
+        return queryset.values_list(*self.columns)
+
+    def serialize_row(self, row):
+        ret = OrderedDict()
+        for name, index, convert in self.steps:
+            if isinstance(index, list):
+                ret[name] = convert([row[i] for i in index])
+                continue
+            value = row[index]
+            if value is None or convert is None:
+                ret[name] = value
+            else:
+                ret[name] = convert(value)
+        return ret
+
+
+def parse_root_services(value):
+    if value == None or value == '':
+        return None
+    return [int(x) for x in value.split(',')]
+
+
 def make_muni_ocd_id(name, rest=None):
     s = 'ocd-division/country:%s/%s:%s' % (settings.DEFAULT_COUNTRY, settings.DEFAULT_OCD_MUNICIPALITY, name)
     if rest:
@@ -430,6 +767,9 @@ def make_muni_ocd_id(name, rest=None):
 
 
 
+# Number of units loaded at a time when streaming exports
+EXPORT_CHUNK_SIZE = 500
+
 def get_fields(place, lang_code, fields):
     for field in fields:
         p = place[field]
@@ -456,20 +796,42 @@ class KmlRenderer(renderers.BaseRenderer):
         return render_to_string('kml.xml', resp)
 
 
-class UnitViewSet(munigeo_api.GeoModelAPIView, JSONAPIViewSet, viewsets.ReadOnlyModelViewSet):
+class UnitViewSet(ConditionalGetMixin, munigeo_api.GeoModelAPIView, JSONAPIViewSet,
+                  viewsets.ReadOnlyModelViewSet):
     queryset = Unit.objects.all()
     serializer_class = UnitSerializer
+    modified_field = 'origin_last_modified_time'
 
     renderer_classes = DEFAULT_RENDERERS + [KmlRenderer]
 
+    # Serve only= listings from values_list() rows when possible
+    use_values_plan = True
+    # Needed for the fragment cache keys
+    only_required_fields = ['origin_last_modified_time']
+
     def get_serializer_context(self):
         ret = super(UnitViewSet, self).get_serializer_context()
         ret['srs'] = self.srs
         return ret
 
+    @property
+    def paginator(self):
+        """
+        Use keyset pagination when asked for with pagination=cursor
+        or when following a cursor link.
+        """
+        if not hasattr(self, '_paginator'):
+            params = self.request.query_params
+            if params.get('pagination') == 'cursor' or 'cursor' in params:
+                self._paginator = KeysetPagination()
+            else:
+                self._paginator = self.pagination_class()
+        return self._paginator
+
     def get_queryset(self):
         queryset = super(UnitViewSet, self).get_queryset()
         filters = self.request.QUERY_PARAMS
+        self.distance_point = None
         if 'id' in filters:
             id_list = filters['id'].split(',')
             queryset = queryset.filter(id__in=id_list)
@@ -505,11 +867,11 @@ class UnitViewSet(munigeo_api.GeoModelAPIView, JSONAPIViewSet, viewsets.ReadOnly
                 level_specs = settings.LEVELS.get(level)
 
         def services_by_ancestors(service_ids):
-            srv_list = set()
-            for srv_id in service_ids:
-                srv_list |= set(Service.objects.all().by_ancestor(srv_id).values_list('id', flat=True))
-                srv_list.add(int(srv_id))
-            return list(srv_list)
+            try:
+                service_ids = [int(x) for x in service_ids]
+            except ValueError:
+                raise ParseError("service IDs must be integers")
+            return Service.objects.by_ancestors(service_ids, include_self=True).values('id')
 
         services = filters.get('service', None)
         service_ids = None
@@ -581,6 +943,7 @@ class UnitViewSet(munigeo_api.GeoModelAPIView, JSONAPIViewSet, viewsets.ReadOnly
                     raise ParseError("'distance' needs to be a floating point number")
                 queryset = queryset.filter(location__distance_lte=(point, distance))
             queryset = queryset.distance(point, field_name='geometry').order_by('distance')
+            self.distance_point = point
 
         if 'bbox' in filters:
             val = self.request.QUERY_PARAMS.get('bbox', None)
@@ -602,6 +965,10 @@ class UnitViewSet(munigeo_api.GeoModelAPIView, JSONAPIViewSet, viewsets.ReadOnly
             queryset = queryset.prefetch_related('observation_set__property__allowed_values').prefetch_related('observation_set__value')
         if 'connections' in self.include_fields:
             queryset = queryset.prefetch_related('connections')
+        if 'services' in self.include_fields:
+            # Everything else is looked up from the service tree snapshot
+            queryset = queryset.prefetch_related(
+                Prefetch('services', queryset=Service.objects.only('id')))
         return queryset
 
     def _add_content_disposition_header(self, response):
@@ -610,65 +977,234 @@ class UnitViewSet(munigeo_api.GeoModelAPIView, JSONAPIViewSet, viewsets.ReadOnly
             response['Content-Disposition'] = header
         return response
 
-    def retrieve(self, request, pk=None):
-        queryset = Unit.objects.all()
+    def get_object(self):
+        pk = self.kwargs['pk']
         try:
-            unit = Unit.objects.get(pk=pk)
+            return Unit.objects.get(pk=pk)
         except Unit.DoesNotExist:
             unit_alias = get_object_or_404(UnitAlias, second=pk)
-            unit = unit_alias.first
+            return unit_alias.first
+
+    def get_extra_validator_data(self):
+        # root_services, and the service names and roots of include=services,
+        # come from the service tree and can change without the units
+        return {'service_tree': get_service_tree().generation}
+
+    def get_rows_validator_data(self, rows, get_id, get_modified):
+        data = super(UnitViewSet, self).get_rows_validator_data(rows, get_id, get_modified)
+        if 'observations' in self.include_fields:
+            data.update(Unit.objects.filter(id__in=data['ids']).aggregate(
+                observation_time=Max('latest_observations__observation__time')))
+        return data
+
+    def get_object_validator_data(self, unit):
+        data = super(UnitViewSet, self).get_object_validator_data(unit)
+        if 'observations' in self.include_fields:
+            data.update(unit.latest_observations.aggregate(
+                observation_time=Max('observation__time')))
+        return data
+
+    def retrieve_object(self, unit):
         serializer = self.serializer_class(unit, context=self.get_serializer_context())
+        if unit_cache_enabled():
+            return Response(unit_cache.serialize([unit], serializer)[0])
         return Response(serializer.data)
 
-    def list(self, request):
-        response = super(UnitViewSet, self).list(request)
-        response.add_post_render_callback(self._add_content_disposition_header)
+    def get_values_plan(self):
+        """
+        Return a UnitValuesPlan for listings limited with only= that
+        can be served from values_list() rows, or None.
+        """
+        if not self.use_values_plan or not self.only_fields:
+            return None
+        if self.distance_point is not None:
+            return None
+        serializer = self.get_serializer(many=True)
+        return UnitValuesPlan.for_serializer(serializer.child)
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        values_plan = self.get_values_plan()
+        if values_plan is None:
+            get_id = attrgetter('id')
+            get_modified = attrgetter('origin_last_modified_time')
+        else:
+            queryset = values_plan.get_queryset(queryset)
+            get_id = itemgetter(values_plan.id_index)
+            get_modified = itemgetter(values_plan.modified_index)
+            if isinstance(self.paginator, KeysetPagination):
+                self.paginator.get_object_id = get_id
+        page = self.paginate_queryset(queryset)
+        rows = page if page is not None else list(queryset)
+        validator_data = self.get_rows_validator_data(rows, get_id, get_modified)
+
+        def build_response():
+            if values_plan is None:
+                data = self.serialize_units(rows)
+            else:
+                data = [values_plan.serialize_row(row) for row in rows]
+            if page is not None:
+                response = self.get_paginated_response(data)
+            else:
+                response = Response(data)
+            response.add_post_render_callback(self._add_content_disposition_header)
+            return response
+        return self.respond_conditionally(validator_data, build_response)
+
+    def serialize_units(self, units):
+        serializer = self.get_serializer(units, many=True)
+        if unit_cache_enabled():
+            return unit_cache.serialize(units, serializer.child)
+        return serializer.data
+
+    def _iter_export_places(self, queryset, context):
+        ser = self.serializer_class(context=context, many=True)
+        for chunk in iter_queryset_chunks(queryset, EXPORT_CHUNK_SIZE):
+            for obj in chunk:
+                yield ser.child.to_representation(obj)
+
+    def _iter_kml(self, queryset, context, lang_code):
+        yield render_to_string('kml_header.xml', {'lang_code': lang_code})
+        placemark = get_template('kml_placemark.xml')
+        for place in self._iter_export_places(queryset, context):
+            place = get_fields(place, lang_code, settings.KML_TRANSLATABLE_FIELDS)
+            yield placemark.render({'place': place})
+        yield render_to_string('kml_footer.xml', {})
+
+    def _iter_geojson(self, queryset, context):
+        yield '{"type": "FeatureCollection", "features": ['
+        separator = ''
+        for place in self._iter_export_places(queryset, context):
+            feature = OrderedDict([
+                ('type', 'Feature'),
+                ('id', place['id']),
+                ('geometry', place.pop('location', None)),
+                ('properties', place),
+            ])
+            yield separator + json.dumps(feature, cls=JSONEncoder)
+            separator = ','
+        yield ']}'
+
+    @list_route(methods=['get'])
+    def export(self, request):
+        """
+        Stream all the units matching the filters as KML or GeoJSON
+        (file_format=kml|geojson), without pagination. Coordinates are
+        in WGS84 unless 'srid' is given. The output is gzipped while it
+        is streamed if the client accepts gzip or asks for it with
+        compress=gzip.
+        """
+        file_format = request.query_params.get('file_format', 'geojson')
+        if file_format not in ('kml', 'geojson'):
+            raise ParseError("'file_format' must be 'kml' or 'geojson'")
+        lang_code = request.query_params.get('language', LANGUAGES[0])
+        if lang_code not in LANGUAGES:
+            raise ParseError("Invalid language supplied. Supported languages: %s" %
+                             ','.join(LANGUAGES))
+
+        queryset = self.filter_queryset(self.get_queryset())
+        context = self.get_serializer_context()
+        if 'srid' not in request.query_params:
+            context['srs'] = SpatialReference(4326)
+
+        if file_format == 'kml':
+            content = self._iter_kml(queryset, context, lang_code)
+            content_type = KmlRenderer.media_type
+        else:
+            content = self._iter_geojson(queryset, context)
+            content_type = 'application/vnd.geo+json'
+        compress = request.query_params.get('compress')
+        if compress not in (None, 'gzip'):
+            raise ParseError("'compress' must be 'gzip'")
+        accepts_gzip = re.search(r'\bgzip\b', request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if compress or accepts_gzip:
+            content = compress_sequence(x.encode('utf8') for x in content)
+        response = StreamingHttpResponse(content, content_type=content_type)
+        response['Content-Disposition'] = 'attachment; filename=palvelukartta.%s' % file_format
+        if compress or accepts_gzip:
+            # Also keeps GZipMiddleware from compressing the response again
+            response['Content-Encoding'] = 'gzip'
+        patch_vary_headers(response, ('Accept-Encoding',))
         return response
 
 register_view(UnitViewSet, 'unit')
 
-class SearchSerializer(serializers.Serializer):
-    def __init__(self, *args, **kwargs):
-        super(SearchSerializer, self).__init__(*args, **kwargs)
-        self.serializer_by_model = {}
-
+class SearchResultListSerializer(serializers.ListSerializer):
+    """
+    Loads the objects of all the search results on a page with one query
+    per model, restricted to the fields requested in this request, and
+    serializes them with a single serializer per model.
+    """
     def _strip_context(self, context, model):
-        if model == Unit:
-            key = 'unit'
-        else:
-            key = 'service'
+        key = model._meta.model_name
         for spec in ['include', 'only']:
             if spec in context:
                 context[spec] = context[spec].get(key, [])
         return context
 
-    def get_result_serializer(self, model, instance):
-        ser = self.serializer_by_model.get(model)
-        if not ser:
-            ser_class = serializers_by_model[model]
+    def get_object_queryset(self, model, context):
+        queryset = model.objects.all()
+        if model == Unit:
+            if context.get('only'):
+                fields = {field.name: field for field in model._meta.get_fields()}
+                for name in context['only']:
+                    if name not in fields:
+                        raise ParseError("field 'unit.%s' supplied in 'only' not found" % name)
+                # Relations are not columns of the unit table
+                queryset = queryset.only(*[name for name in context['only']
+                                           if fields[name].concrete and not fields[name].many_to_many])
+            if context.get('include'):
+                for name in context['include']:
+                    if name not in UNIT_INCLUDE_RELATIONS:
+                        raise ParseError("'unit.%s' can not be included. Supported: %s" % (
+                            name, ', '.join('unit.%s' % x for x in UNIT_INCLUDE_RELATIONS)))
+                queryset = queryset.prefetch_related(*context['include'])
+        return queryset
+
+    def to_representation(self, data):
+        results_by_model = OrderedDict()
+        for result in data:
+            if result and result.model:
+                results_by_model.setdefault(result.model, []).append(result)
+
+        data_by_result = {}
+        for model, results in results_by_model.items():
             assert model in serializers_by_model, "Serializer for %s not found" % model
             context = self._strip_context(self.context.copy(), model)
-            ser = ser_class(context=context, many=False)
-            self.serializer_by_model[model] = ser
-        # TODO: another way to serialize with new data without
-        # costly Serializer instantiation
-        ser.instance = instance
-        if hasattr(ser, '_data'):
-            del ser._data
-        return ser
-
-    def to_representation(self, search_result):
-        if not search_result or not search_result.model:
-            return None
-        model = search_result.model
-        serializer = self.get_result_serializer(
-            model, search_result.object)
-        data = serializer.data
-        data['object_type'] = model._meta.model_name
-        data['score'] = search_result.score
-        return data
+            queryset = self.get_object_queryset(model, context)
+            objs = queryset.in_bulk([result.pk for result in results])
+            objs = {str(pk): obj for pk, obj in objs.items()}
+
+            ser = serializers_by_model[model](context=context, many=True)
+            for result in results:
+                obj = objs.get(str(result.pk))
+                if obj is None:
+                    # Deleted after it was indexed
+                    continue
+                result._object = obj
+                obj_data = ser.child.to_representation(obj)
+                obj_data['object_type'] = model._meta.model_name
+                obj_data['score'] = result.score
+                data_by_result[id(result)] = obj_data
+
+        return [data_by_result[id(result)] for result in data if id(result) in data_by_result]
+
+
+class SearchSerializer(serializers.Serializer):
+    class Meta:
+        list_serializer_class = SearchResultListSerializer
 
 KML_REGEXP = re.compile(settings.KML_REGEXP)
+# Public facet names and the index fields they are computed on
+SEARCH_FACETS = OrderedDict([
+    ('type', 'django_ct'),
+    ('municipality', 'municipality'),
+    ('root_services', 'root_services'),
+])
+SEARCH_FACET_SIZE = 100
+
+# Scale of the gaussian distance decay applied to search scores
+SEARCH_DISTANCE_DECAY_SCALE = getattr(settings, 'SEARCH_DISTANCE_DECAY_SCALE', '2km')
 
 class SearchViewSet(munigeo_api.GeoModelAPIView, viewsets.ViewSetMixin, generics.ListAPIView):
     serializer_class = SearchSerializer
@@ -681,6 +1217,16 @@ class SearchViewSet(munigeo_api.GeoModelAPIView, viewsets.ViewSetMixin, generics
             raise ParseError("Invalid language supplied. Supported languages: %s" %
                              ','.join(LANGUAGES))
 
+        is_kml = hasattr(request, 'accepted_media_type') and re.match(KML_REGEXP, request.accepted_media_type)
+        cache_key = None
+        if not is_kml:
+            cache_key = search_cache.make_key(request, LANGUAGES[0])
+            data = search_cache.get(cache_key)
+            if data is not None:
+                resp = Response(data)
+                resp['X-Search-Cache'] = 'hit'
+                return resp
+
         context = {}
 
         specs = {
@@ -692,6 +1238,8 @@ class SearchViewSet(munigeo_api.GeoModelAPIView, viewsets.ViewSetMixin, generics
                 setattr(self, key, {})
                 fields = [x.strip().split('.') for x in specs[key].split(',') if x]
                 for f in fields:
+                    if len(f) != 2:
+                        raise ParseError("'%s' must be of form 'type.field'" % key.split('_')[0])
                     getattr(self, key).setdefault(f[0], []).append(f[1])
             else:
                 setattr(self, key, None)
@@ -706,11 +1254,12 @@ class SearchViewSet(munigeo_api.GeoModelAPIView, viewsets.ViewSetMixin, generics
         old_language = translation.get_language()[:2]
         translation.activate(self.lang_code)
 
-        queryset = SearchQuerySet()
+        queryset = CustomEsSearchQuerySet()
 
-        if hasattr(request, 'accepted_media_type') and re.match(KML_REGEXP, request.accepted_media_type):
+        if is_kml:
             queryset = queryset.models(Unit)
-            self.only_fields['unit'].extend(['street_address', 'www_url'])
+            if self.only_fields and 'unit' in self.only_fields:
+                self.only_fields['unit'].extend(['street_address', 'www_url'])
 
         if input_val:
             queryset = (
@@ -726,10 +1275,11 @@ class SearchViewSet(munigeo_api.GeoModelAPIView, viewsets.ViewSetMixin, generics
                 .filter_or(extra_searchwords=q_val)
                 .filter_or(address=q_val)
             )
+        municipalities = None
         if 'municipality' in request.QUERY_PARAMS:
             val = request.QUERY_PARAMS['municipality'].lower().strip()
             if len(val) > 0:
-                municipalities = val.split(',')
+                municipalities = [m.strip() for m in val.split(',')]
                 muni_q_objects = [SQ(municipality=m.strip()) for m in municipalities]
                 muni_q = muni_q_objects.pop()
                 for q in muni_q_objects:
@@ -753,22 +1303,103 @@ class SearchViewSet(munigeo_api.GeoModelAPIView, viewsets.ViewSetMixin, generics
         if len(models) > 0:
             queryset = queryset.models(*list(models))
 
-        only = getattr(self, 'only_fields') or {}
-        include = getattr(self, 'include_fields') or {}
-        Unit.search_objects.only_fields = only.get('unit')
-        Unit.search_objects.include_fields = include.get('unit')
+        queryset, geo_filtered = self.filter_geo(queryset)
+
+        facets = [x.strip() for x in request.QUERY_PARAMS.get('facets', '').split(',') if x.strip()]
+        for facet in facets:
+            if facet not in SEARCH_FACETS:
+                raise ParseError("Invalid facet '%s'. Supported facets: %s" %
+                                 (facet, ','.join(SEARCH_FACETS.keys())))
+            queryset = queryset.facet(SEARCH_FACETS[facet], size=SEARCH_FACET_SIZE)
 
-        self.object_list = queryset.load_all()
+        self.object_list = None
+        if (input_val and not service and not geo_filtered and not facets and not is_kml and
+                settings.SEARCH_AUTOSUGGEST_INDEX):
+            # Single words are answered from memory; None falls back to the backend
+            self.object_list = get_autosuggest_index().suggest(
+                self.lang_code, input_val, models=models, municipalities=municipalities)
+        if self.object_list is None:
+            self.object_list = queryset
 
         # Switch between paginated or standard style responses
         page = self.paginate_queryset(self.object_list)
         serializer = self.get_serializer(page, many=True)
         resp = self.get_paginated_response(serializer.data)
+        if facets:
+            # Read after fetching the page so that no extra query is made
+            resp.data['facets'] = self.get_facet_counts(facets)
 
         translation.activate(old_language)
 
+        if cache_key:
+            search_cache.set(cache_key, resp.data)
+            resp['X-Search-Cache'] = 'miss'
         return resp
 
+    def get_facet_counts(self, facets):
+        unified_index = haystack_connections[self.object_list.query._using].get_unified_index()
+        field_counts = self.object_list.facet_counts().get('fields', {})
+        ret = OrderedDict()
+        for facet in facets:
+            field_name = unified_index.get_facet_fieldname(SEARCH_FACETS[facet])
+            counts = OrderedDict()
+            for value, count in field_counts.get(field_name, []):
+                if facet == 'type':
+                    # 'services.unit' -> 'unit'
+                    value = value.split('.')[-1]
+                counts[str(value)] = count
+            ret[facet] = counts
+        return ret
+
+    def filter_geo(self, queryset):
+        """
+        Apply the lat/lon/distance and bbox parameters inside the search
+        engine. Returns the queryset and whether it was filtered or scored
+        by location. Only documents with a location match the filters.
+        """
+        params = self.request.QUERY_PARAMS
+        geo_filtered = False
+        if ('lat' in params and 'lon' in params) or params.get('bbox'):
+            if isinstance(queryset.query.backend, SimpleSearchBackend):
+                # The simple backend silently ignores dwithin() and within()
+                raise ParseError("Location filters ('lat', 'lon' and 'bbox') are not supported "
+                                 "by the configured search backend")
+        if 'lat' in params and 'lon' in params:
+            try:
+                lat = float(params['lat'])
+                lon = float(params['lon'])
+            except ValueError:
+                raise ParseError("'lat' and 'lon' need to be floating point numbers")
+            point = Point(lon, lat, srid=4326)
+            geo_filtered = True
+
+            if 'distance' in params:
+                try:
+                    distance = float(params['distance'])
+                    if not distance > 0:
+                        raise ValueError()
+                except ValueError:
+                    raise ParseError("'distance' needs to be a floating point number")
+                queryset = queryset.dwithin('location', point, D(m=distance))
+            if hasattr(queryset.query, 'add_decay_function'):
+                queryset = queryset.decay({'gauss': {'location': {
+                    'origin': '%s,%s' % (lat, lon), 'scale': SEARCH_DISTANCE_DECAY_SCALE}}})
+
+        val = params.get('bbox', None)
+        if val:
+            if 'bbox_srid' in params:
+                ref = SpatialReference(params['bbox_srid'])
+            else:
+                ref = self.srs
+            poly = munigeo_api.poly_from_bbox(val)
+            poly.srid = ref.srid
+            poly.transform(4326)
+            min_lon, min_lat, max_lon, max_lat = poly.extent
+            queryset = queryset.within('location', Point(min_lon, min_lat, srid=4326),
+                                       Point(max_lon, max_lat, srid=4326))
+            geo_filtered = True
+        return queryset, geo_filtered
+
     def get_serializer_context(self):
         context = super(SearchViewSet, self).get_serializer_context()
         if self.only_fields:
@@ -779,6 +1410,14 @@ class SearchViewSet(munigeo_api.GeoModelAPIView, viewsets.ViewSetMixin, generics
 
 register_view(SearchViewSet, 'search', base_name='search')
 
+class SearchCacheStatsView(viewsets.ViewSetMixin, generics.ListAPIView):
+    serializer_class = None
+
+    def list(self, request, *args, **kwargs):
+        return Response(search_cache.get_stats())
+
+register_view(SearchCacheStatsView, 'search_cache_stats', base_name='search_cache_stats')
+
 class AccessibilityRuleView(viewsets.ViewSetMixin, generics.ListAPIView):
     serializer_class = None
 
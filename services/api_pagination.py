@@ -1,5 +1,15 @@
-from rest_framework.pagination import PageNumberPagination
+from collections import OrderedDict
+import base64
+import json
+from operator import attrgetter
+
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 from django.conf import settings
+from django.contrib.gis.measure import D
+from django.db.models import Q
 import re
 
 KML_REGEXP = re.compile(settings.KML_REGEXP)
@@ -12,3 +22,92 @@ class Pagination(PageNumberPagination):
         if hasattr(request, 'accepted_media_type') and re.match(KML_REGEXP, request.accepted_media_type):
             return 30000
         return super(Pagination, self).get_page_size(request)
+
+
+class KeysetPagination(BasePagination):
+    """
+    Forward-only pagination that continues after the last object of the
+    previous page instead of using OFFSET, and leaves out the total count.
+    Objects are ordered by id, or by distance and id when the view has
+    set `distance_point`. The position is passed in an opaque `cursor`
+    parameter.
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    page_size = settings.REST_FRAMEWORK['PAGE_SIZE']
+    max_page_size = 1000
+    invalid_cursor_message = 'Invalid cursor'
+    # Views paginating values_list() rows replace this
+    get_object_id = attrgetter('id')
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+            if page_size > 0:
+                return min(page_size, self.max_page_size)
+        except (KeyError, ValueError):
+            pass
+        return self.page_size
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(encoded.encode('ascii')).decode('utf8'))
+            cursor['id'] = int(cursor['id'])
+            if cursor.get('distance') is not None:
+                cursor['distance'] = float(cursor['distance'])
+        except (TypeError, ValueError, KeyError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+        return cursor
+
+    def encode_cursor(self, cursor):
+        encoded = base64.urlsafe_b64encode(json.dumps(cursor).encode('utf8')).decode('ascii')
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.base_url = request.build_absolute_uri()
+        self.page_size = self.get_page_size(request)
+        self.point = getattr(view, 'distance_point', None)
+        cursor = self.decode_cursor(request)
+
+        if self.point is not None:
+            queryset = queryset.order_by('distance', 'id')
+            if cursor is not None:
+                queryset = queryset.filter(self.get_distance_filter(cursor))
+        else:
+            queryset = queryset.order_by('id')
+            if cursor is not None:
+                queryset = queryset.filter(id__gt=cursor['id'])
+
+        results = list(queryset[:self.page_size + 1])
+        self.has_next = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        return self.page
+
+    def get_distance_filter(self, cursor):
+        # Units without a geometry come last in distance order
+        after_q = Q(geometry__isnull=True, id__gt=cursor['id'])
+        if cursor.get('distance') is None:
+            return after_q
+        distance = D(m=cursor['distance'])
+        return (Q(geometry__distance_gt=(self.point, distance)) |
+                Q(geometry__distance_gte=(self.point, distance), id__gt=cursor['id']) |
+                Q(geometry__isnull=True))
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        last = self.page[-1]
+        cursor = {'id': self.get_object_id(last)}
+        if self.point is not None:
+            distance = getattr(last, 'distance', None)
+            cursor['distance'] = distance.m if distance is not None else None
+        return self.encode_cursor(cursor)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data)
+        ]))
@@ -0,0 +1,176 @@
+"""
+In-memory prefix index for autosuggest queries.
+
+The names of services and units and their keywords form a bounded
+vocabulary, so single-word `input=` queries are answered from a sorted
+per-language list of words instead of the search backend. Scoring
+mirrors the search index fields: a prefix match on a name word
+(`autosuggest`) and on a keyword (`autosuggest_extra_searchwords`) each
+count 1.0, and an exact name match (`autosuggest_exact`) adds its boost
+of 1.125. The index is rebuilt when the search index generation changes
+(bumped by update_index_changeset) and, because other importers and the
+stock haystack commands do not bump it, whenever it is older than
+SEARCH_AUTOSUGGEST_MAX_AGE seconds.
+"""
+import threading
+import time
+from bisect import bisect_left
+from collections import namedtuple
+
+from django.conf import settings
+from haystack.models import SearchResult
+
+from services.models import Service, Unit, DataGeneration
+from services.search_indexes import SEARCH_INDEX_GENERATION
+
+LANGUAGES = [x[0] for x in settings.LANGUAGES]
+
+# How often (in seconds) the generation counter is checked
+CHECK_INTERVAL = getattr(settings, 'SEARCH_AUTOSUGGEST_CHECK_INTERVAL', 10)
+# Maximum age (in seconds) of the index regardless of the generation
+MAX_AGE = getattr(settings, 'SEARCH_AUTOSUGGEST_MAX_AGE', 900)
+
+FIELD_SCORES = {'name': 1.0, 'keyword': 1.0}
+EXACT_BOOST = 1.125
+
+SuggestEntry = namedtuple('SuggestEntry', ['app_label', 'model_name', 'pk', 'name', 'municipality'])
+
+
+def normalize(text):
+    return ' '.join(text.lower().split())
+
+
+class LanguageIndex(object):
+    def __init__(self):
+        self.entries = []
+        self.words = []
+        self._postings = {}
+
+    def add(self, entry, name, keywords):
+        entry_idx = len(self.entries)
+        self.entries.append(entry)
+        for word in set(normalize(name).split()):
+            self._postings.setdefault(word, []).append((entry_idx, 'name'))
+        for word in set(w for kw in keywords for w in normalize(kw).split()):
+            self._postings.setdefault(word, []).append((entry_idx, 'keyword'))
+
+    def freeze(self):
+        self.words = sorted(self._postings.keys())
+        self.postings = [self._postings[word] for word in self.words]
+        del self._postings
+
+    def find(self, prefix):
+        """
+        Return a dict of entry index -> score for the entries whose name
+        or keywords contain a word starting with `prefix`.
+        """
+        # A name and a keyword match both count, but only once each
+        matched = set()
+        idx = bisect_left(self.words, prefix)
+        while idx < len(self.words) and self.words[idx].startswith(prefix):
+            matched.update(self.postings[idx])
+            idx += 1
+        totals = {}
+        for entry_idx, field in matched:
+            totals[entry_idx] = totals.get(entry_idx, 0) + FIELD_SCORES[field]
+        return totals
+
+
+class AutosuggestIndex(object):
+    def __init__(self, generation, languages):
+        self.generation = generation
+        self.languages = languages
+        self.built_at = time.time()
+
+    def is_current(self, generation, now):
+        return self.generation == generation and now - self.built_at < MAX_AGE
+
+    @classmethod
+    def load(cls, generation):
+        languages = {}
+        for lang in LANGUAGES:
+            index = LanguageIndex()
+            cls._add_model(index, lang, Service.objects.filter(identical_to=None), Service, None)
+            cls._add_model(index, lang, Unit.objects.all(), Unit, 'municipality_id')
+            index.freeze()
+            languages[lang] = index
+        return cls(generation, languages)
+
+    @staticmethod
+    def _add_model(index, lang, queryset, model, municipality_field):
+        keywords = {}
+        through = model.keywords.through
+        owner_field = '%s_id' % model._meta.model_name
+        kw_rows = through.objects.filter(keyword__language=lang).values_list(owner_field, 'keyword__name')
+        for obj_id, name in kw_rows:
+            keywords.setdefault(obj_id, []).append(name)
+
+        fields = ['id', 'name_%s' % lang, 'name']
+        if municipality_field:
+            fields.append(municipality_field)
+        for row in queryset.values_list(*fields):
+            obj_id, name = row[0], row[1] or row[2]
+            if not name:
+                continue
+            municipality = row[3] if municipality_field else None
+            entry = SuggestEntry(model._meta.app_label, model._meta.model_name, obj_id, name, municipality)
+            index.add(entry, name, keywords.get(obj_id, []))
+
+    def suggest(self, language, input_val, models=None, municipalities=None):
+        """
+        Return the matching entries as SearchResults ordered by score,
+        or None if the input should be handled by the search backend.
+        """
+        query = normalize(input_val)
+        index = self.languages.get(language)
+        if index is None or not query or ' ' in query:
+            return None
+        model_names = None
+        if models:
+            model_names = set((m._meta.app_label, m._meta.model_name) for m in models)
+
+        matches = []
+        for entry_idx, score in index.find(query).items():
+            entry = index.entries[entry_idx]
+            if model_names is not None and (entry.app_label, entry.model_name) not in model_names:
+                continue
+            # Like the backend filter, services pass the municipality filter
+            if municipalities and entry.model_name == 'unit' and entry.municipality not in municipalities:
+                continue
+            if normalize(entry.name) == query:
+                score += EXACT_BOOST
+            matches.append((-score, len(entry.name), entry.name, entry))
+        if not matches:
+            return None
+        matches.sort(key=lambda x: x[:3])
+        return [SearchResult(entry.app_label, entry.model_name, entry.pk, -neg_score)
+                for neg_score, _, _, entry in matches]
+
+
+_index = None
+_last_check = 0
+_lock = threading.Lock()
+
+
+def get_autosuggest_index():
+    """
+    Return the current autosuggest index, rebuilding it if the search
+    index generation has been bumped since it was built or if it has
+    reached its maximum age.
+    """
+    global _index, _last_check
+
+    now = time.time()
+    index = _index
+    if index is not None and now - _last_check < CHECK_INTERVAL:
+        return index
+
+    with _lock:
+        if _index is not index:
+            return _index
+        generation = DataGeneration.objects.current(SEARCH_INDEX_GENERATION)
+        if index is None or not index.is_current(generation, now):
+            index = AutosuggestIndex.load(generation)
+            _index = index
+        _last_check = now
+    return index
@@ -0,0 +1,79 @@
+"""
+In-process translation table for unit extension values.
+
+Extension values (lighting, skiing technique, maintenance group...)
+come from a small set of message ids, but translating them with
+translation.override() for every key and language of every unit is
+slow. Instead each worker memoizes the translations of every value it
+has seen. The table is thrown away when Django reloads its translation
+catalogs (e.g. when LANGUAGES or LOCALE_PATHS change).
+"""
+import threading
+
+from django.conf import settings
+from django.utils.translation import trans_real
+
+LANGUAGES = [x[0] for x in settings.LANGUAGES]
+
+# Upper bound for the number of memoized values; free-form extension
+# values must not grow the table without limit.
+MAX_VALUES = 10000
+
+
+class ExtensionTranslationTable(object):
+    def __init__(self, catalogs):
+        # List of (language, translation object) pairs
+        self.catalogs = catalogs
+        self.table = {}
+
+    @classmethod
+    def load(cls):
+        return cls([(lang, trans_real.translation(lang)) for lang in LANGUAGES])
+
+    def is_current(self):
+        return all(trans_real.translation(lang) is catalog
+                   for lang, catalog in self.catalogs)
+
+    def translate(self, value):
+        """
+        Return a dict of language -> translation for the languages in
+        which the value has a translation differing from the message id.
+        Matches what ugettext() gives inside translation.override().
+        """
+        try:
+            return self.table[value]
+        except KeyError:
+            pass
+        message = value.replace('\r\n', '\n').replace('\r', '\n')
+        translations = {}
+        if message:
+            for lang, catalog in self.catalogs:
+                translated = catalog.gettext(message)
+                if translated != value:
+                    translations[lang] = translated
+        if len(self.table) >= MAX_VALUES:
+            self.table = {}
+        self.table[value] = translations
+        return translations
+
+
+_table = None
+_lock = threading.Lock()
+
+
+def get_extension_translations():
+    """
+    Return the current translation table, rebuilding it if the
+    translation catalogs have been reloaded since it was created.
+    """
+    global _table
+
+    table = _table
+    if table is not None and table.is_current():
+        return table
+    with _lock:
+        if _table is not table:
+            # Another thread reloaded while we were waiting
+            return _table
+        _table = ExtensionTranslationTable.load()
+        return _table
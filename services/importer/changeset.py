@@ -0,0 +1,46 @@
+import json
+
+
+class Changeset(object):
+    """
+    Ids of the objects created, changed and deleted during an import,
+    grouped by model label (e.g. 'services.unit'). Saved as JSON so that
+    the search index can be updated for exactly these objects.
+    """
+    ACTIONS = ('created', 'changed', 'deleted')
+
+    def __init__(self, changes=None):
+        self.changes = {}
+        for label, actions in (changes or {}).items():
+            for action, ids in actions.items():
+                self.add_many(label, action, ids)
+
+    def add(self, label, action, obj_id):
+        self.add_many(label, action, [obj_id])
+
+    def add_many(self, label, action, obj_ids):
+        assert action in self.ACTIONS, "Invalid action %s" % action
+        actions = self.changes.setdefault(label, {x: set() for x in self.ACTIONS})
+        actions[action].update(obj_ids)
+
+    def get(self, label, action):
+        return self.changes.get(label, {}).get(action, set())
+
+    def labels(self):
+        return sorted(self.changes.keys())
+
+    def count(self):
+        return sum(len(ids) for actions in self.changes.values() for ids in actions.values())
+
+    def to_json(self):
+        return {label: {action: sorted(ids) for action, ids in actions.items()}
+                for label, actions in self.changes.items()}
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_json(), f, indent=2, sort_keys=True)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            return cls(json.load(f))
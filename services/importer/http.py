@@ -0,0 +1,118 @@
+"""
+Pooled HTTP access to the Palvelukartta REST API.
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from services.importer.stream import iter_json_array
+
+# Size of the HTTP reads when streaming large resources
+STREAM_CHUNK_SIZE = 64 * 1024
+
+RETRY_STATUSES = [500, 502, 503, 504]
+
+
+class PalvelukarttaClient(object):
+    """
+    Fetches resources through a single pooled session, retrying
+    failed requests with exponential backoff. Independent resources
+    can be fetched in parallel with `run_parallel()` and `get_many()`.
+    The time spent on each resource is collected in `timings`.
+    """
+    def __init__(self, base_url, concurrency=4, retries=3, backoff_factor=0.5, timeout=120):
+        self.base_url = base_url
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+        self.timings = {}
+        self._lock = threading.Lock()
+
+        retry = Retry(total=retries, backoff_factor=backoff_factor,
+                      status_forcelist=RETRY_STATUSES)
+        adapter = HTTPAdapter(pool_connections=self.concurrency,
+                              pool_maxsize=self.concurrency, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def make_url(self, resource_name, res_id=None):
+        url = "%s%s/" % (self.base_url, resource_name)
+        if res_id is not None:
+            url = "%s%s/" % (url, res_id)
+        return url
+
+    def _record(self, name, start_time):
+        self._record_elapsed(name, time.time() - start_time)
+
+    def _record_elapsed(self, name, elapsed):
+        with self._lock:
+            count, total = self.timings.get(name, (0, 0.0))
+            self.timings[name] = (count + 1, total + elapsed)
+
+    def _request(self, url, **kwargs):
+        resp = self.session.get(url, timeout=self.timeout, **kwargs)
+        if resp.status_code != 200:
+            raise requests.HTTPError("GET %s returned %d" % (url, resp.status_code), response=resp)
+        return resp
+
+    def get(self, resource_name, res_id=None):
+        start_time = time.time()
+        resp = self._request(self.make_url(resource_name, res_id))
+        data = resp.json()
+        self._record(resource_name, start_time)
+        return data
+
+    def stream(self, resource_name):
+        """
+        Yield the objects of a list resource as they are received. Only
+        the time spent fetching and decoding is recorded, not the time
+        the caller spends processing the objects.
+        """
+        start_time = time.time()
+        resp = self._request(self.make_url(resource_name), stream=True)
+        elapsed = time.time() - start_time
+        try:
+            objs = iter_json_array(resp.iter_content(chunk_size=STREAM_CHUNK_SIZE))
+            while True:
+                start_time = time.time()
+                try:
+                    obj = next(objs)
+                except StopIteration:
+                    break
+                finally:
+                    elapsed += time.time() - start_time
+                yield obj
+        finally:
+            resp.close()
+        self._record_elapsed(resource_name, elapsed)
+
+    def run_parallel(self, tasks):
+        """
+        Run a dict of name -> callable concurrently and return a dict
+        of name -> result. Exceptions are re-raised in the caller.
+        """
+        if self.concurrency == 1 or len(tasks) < 2:
+            return {name: func() for name, func in tasks.items()}
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = {name: executor.submit(func) for name, func in tasks.items()}
+            return {name: future.result() for name, future in futures.items()}
+
+    def get_many(self, resource_name, res_ids):
+        """
+        Fetch several objects of the same resource concurrently.
+        Returns the objects in the order of `res_ids`.
+        """
+        tasks = {res_id: (lambda res_id=res_id: self.get(resource_name, res_id))
+                 for res_id in res_ids}
+        results = self.run_parallel(tasks)
+        return [results[res_id] for res_id in res_ids]
+
+    def format_timings(self):
+        lines = []
+        for name, (count, total) in sorted(self.timings.items()):
+            lines.append("%-25s %4d requests %8.2f s" % (name, count, total))
+        return '\n'.join(lines)
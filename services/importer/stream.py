@@ -0,0 +1,112 @@
+"""
+Helpers for processing large importer payloads incrementally.
+"""
+import codecs
+import json
+
+from itertools import islice
+
+# Drop already decoded data from the buffer once this many
+# characters have been consumed.
+BUFFER_COMPACT_SIZE = 64 * 1024
+
+
+def iter_json_array(chunks, encoding='utf-8'):
+    """
+    Incrementally decode a JSON array from an iterable of byte chunks
+    (e.g. `Response.iter_content()`), yielding each element as soon as
+    it has been received completely. Only the current element is kept
+    in memory, not the whole document.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder(encoding)()
+    chunks = iter(chunks)
+    buf = ''
+    pos = 0
+    exhausted = False
+
+    def fill():
+        nonlocal buf, pos, exhausted
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            buf += text_decoder.decode(b'', final=True)
+            exhausted = True
+            return
+        if isinstance(chunk, bytes):
+            chunk = text_decoder.decode(chunk)
+        if pos > BUFFER_COMPACT_SIZE:
+            buf = buf[pos:]
+            pos = 0
+        buf += chunk
+
+    def skip_whitespace(extra=''):
+        nonlocal pos
+        while True:
+            while pos < len(buf) and (buf[pos].isspace() or buf[pos] in extra):
+                pos += 1
+            if pos < len(buf) or exhausted:
+                return
+            fill()
+
+    skip_whitespace()
+    if pos >= len(buf) or buf[pos] != '[':
+        raise ValueError("Expected a JSON array")
+    pos += 1
+
+    while True:
+        skip_whitespace(',')
+        if pos >= len(buf):
+            raise ValueError("Unexpected end of JSON array")
+        if buf[pos] == ']':
+            return
+        try:
+            obj, end = decoder.raw_decode(buf, pos)
+        except ValueError:
+            if exhausted:
+                raise
+            fill()
+            continue
+        if end >= len(buf) or not (buf[end].isspace() or buf[end] in ',]'):
+            # A value is complete only when followed by a separator. A
+            # number may continue in the next chunk ("2." + "5"), so
+            # decode it again with more data.
+            if not exhausted:
+                fill()
+                continue
+            if end < len(buf):
+                raise ValueError("Unexpected data after a JSON value at %d" % end)
+        pos = end
+        yield obj
+
+
+def iter_chunks(iterable, size):
+    """
+    Split an iterable into lists of at most `size` items.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def iter_queryset_chunks(queryset, size):
+    """
+    Yield the objects of a queryset as lists of at most `size` objects,
+    paging by primary key instead of OFFSET so that every chunk is an
+    index range scan. Only one chunk is held in memory at a time.
+    """
+    pk_name = queryset.model._meta.pk.name
+    queryset = queryset.order_by(pk_name)
+    last_pk = None
+    while True:
+        qs = queryset
+        if last_pk is not None:
+            qs = qs.filter(**{'%s__gt' % pk_name: last_pk})
+        chunk = list(qs[:size])
+        if not chunk:
+            return
+        yield chunk
+        last_pk = chunk[-1].pk
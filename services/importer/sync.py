@@ -0,0 +1,47 @@
+class LazyModelSyncher(object):
+    """
+    Work-alike of munigeo's ModelSyncher that only reads the ids of the
+    existing objects up front. The objects themselves are loaded on
+    demand with `load()`, one chunk at a time, so unchanged objects
+    never need to be instantiated.
+    """
+    def __init__(self, queryset):
+        self.queryset = queryset
+        self.existing_ids = set(queryset.values_list('pk', flat=True))
+        self.marked_ids = set()
+        self.obj_dict = {}
+
+    def load(self, obj_ids):
+        """
+        Replace the currently loaded objects with the existing
+        objects among `obj_ids`.
+        """
+        ids = [obj_id for obj_id in obj_ids if obj_id in self.existing_ids]
+        self.obj_dict = {}
+        if not ids:
+            return
+        for obj in self.queryset.filter(pk__in=ids):
+            obj._found = False
+            obj._changed = False
+            self.obj_dict[obj.pk] = obj
+
+    def get(self, obj_id):
+        return self.obj_dict.get(obj_id, None)
+
+    def mark_id(self, obj_id):
+        if obj_id in self.marked_ids:
+            raise Exception("Object %s already marked" % obj_id)
+        self.marked_ids.add(obj_id)
+
+    def mark(self, obj):
+        self.mark_id(obj.pk)
+        obj._found = True
+
+    def finish(self):
+        delete_ids = self.existing_ids - self.marked_ids
+        if len(delete_ids) > 5 and len(delete_ids) > len(self.existing_ids) * 0.4:
+            raise Exception("Attempting to delete more than 40% of total items")
+        for obj in self.queryset.filter(pk__in=delete_ids):
+            print("Deleting object %s" % obj)
+            obj.delete()
+        return delete_ids
@@ -0,0 +1,60 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.utils import translation
+
+from services.api import LANGUAGES, UnitSerializer
+from services.models import Unit
+
+
+def translate_with_override(extensions):
+    # The per-request translation done before the translation table
+    result = {}
+    for key, value in extensions.items():
+        if value == None or value == 'None':
+            result[key] = None
+            continue
+        translations = {}
+        for lang in LANGUAGES:
+            with translation.override(lang):
+                translated_value = translation.ugettext(value)
+                if translated_value != value:
+                    translations[lang] = translated_value
+        result[key] = translations or value
+    return result
+
+
+class Command(BaseCommand):
+    help = ("Compare translating unit extensions with translation.override() "
+            "against the memoized extension translation table")
+
+    option_list = list(BaseCommand.option_list + (
+        make_option('--service', dest='service', type='int',
+                    help='only use units of this service (e.g. ski tracks)'),
+        make_option('--repeat', dest='repeat', type='int', default=5,
+                    help='number of timed rounds'),
+    ))
+
+    def handle(self, *args, **options):
+        qs = Unit.objects.filter(extensions__isnull=False)
+        if options['service']:
+            qs = qs.filter(services=options['service'])
+        extensions = list(qs.values_list('extensions', flat=True))
+        if not extensions:
+            print("No units with extensions found")
+            return
+
+        serializer = UnitSerializer()
+        methods = [('override', translate_with_override),
+                   ('table', serializer.handle_extension_translations)]
+        for name, func in methods:
+            timings = []
+            for i in range(options['repeat']):
+                start_time = time.time()
+                for ext in extensions:
+                    func(ext)
+                timings.append(time.time() - start_time)
+            best = min(timings)
+            print("%-10s %d units: best %.3f s (%.0f units/s)" % (
+                name, len(extensions), best, len(extensions) / best if best else 0))
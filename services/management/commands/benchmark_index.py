@@ -0,0 +1,60 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from haystack import connections
+from haystack.constants import DEFAULT_ALIAS
+
+from services.importer.stream import iter_chunks
+
+
+class Command(BaseCommand):
+    help = ("Measure search indexing throughput with different numbers of "
+            "per-language worker threads. Note that the objects are written "
+            "to the index.")
+
+    option_list = list(BaseCommand.option_list + (
+        make_option('-b', '--batch-size', dest='batch_size', type='int', default=1000,
+                    help='number of objects to index at a time'),
+        make_option('-u', '--using', dest='using', default=DEFAULT_ALIAS,
+                    help='search connection to benchmark'),
+        make_option('--workers', dest='workers', default='1,3',
+                    help='comma-separated list of worker counts to compare'),
+        make_option('--limit', dest='limit', type='int',
+                    help='index at most this many objects of each model'),
+    ))
+
+    def index_all(self, backend, unified_index):
+        count = 0
+        for model in unified_index.get_indexed_models():
+            index = unified_index.get_index(model)
+            qs = index.build_queryset(using=self.options['using']).order_by('pk')
+            if self.options['limit']:
+                qs = qs[:self.options['limit']]
+            pks = list(qs.values_list('pk', flat=True))
+            for batch in iter_chunks(pks, self.options['batch_size']):
+                objs = list(index.build_queryset(using=self.options['using']).filter(pk__in=batch))
+                backend.update(index, objs)
+                count += len(objs)
+        return count
+
+    def handle(self, *args, **options):
+        self.options = options
+        connection = connections[options['using']]
+        backend = connection.get_backend()
+        unified_index = connection.get_unified_index()
+        if not hasattr(backend, 'index_workers'):
+            print("Connection %s is not multilingual" % options['using'])
+            return
+
+        original_workers = backend.index_workers
+        try:
+            for workers in [int(x) for x in options['workers'].split(',')]:
+                backend.index_workers = workers
+                start_time = time.time()
+                count = self.index_all(backend, unified_index)
+                elapsed = time.time() - start_time
+                print("%2d workers: %6d objects in %7.2f s (%.1f objects/s)" % (
+                    workers, count, elapsed, count / elapsed if elapsed else 0))
+        finally:
+            backend.index_workers = original_workers
@@ -0,0 +1,68 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from munigeo import api as munigeo_api
+from services.api import UnitViewSet, UnitValuesPlan
+from services.models import Unit
+
+
+class Command(BaseCommand):
+    help = ("Compare unit serialization with and without the compiled serialization "
+            "plan, and from values_list() rows when only= allows it")
+
+    option_list = list(BaseCommand.option_list + (
+        make_option('--count', dest='count', type='int', default=1000,
+                    help='number of units to serialize'),
+        make_option('--repeat', dest='repeat', type='int', default=5,
+                    help='number of timed rounds'),
+        make_option('--query', dest='query', default='',
+                    help='query string of the simulated request, e.g. "include=services&geometry=true"'),
+    ))
+
+    def make_serializer(self, params, use_plan):
+        request = Request(APIRequestFactory().get('/v1/unit/', params))
+        context = {'request': request, 'srs': munigeo_api.DEFAULT_SRS}
+        for spec in ('include', 'only'):
+            if params.get(spec):
+                context[spec] = params[spec].split(',')
+        ser = UnitViewSet.serializer_class(context=context, many=True)
+        ser.child.use_plan = use_plan
+        return ser
+
+    def handle(self, *args, **options):
+        params = dict(x.split('=', 1) for x in options['query'].split('&') if '=' in x)
+        qs = Unit.objects.all().order_by('id')
+        if params.get('only'):
+            qs = qs.only(*params['only'].split(','))
+        units = list(qs.prefetch_related('keywords', 'services')[:options['count']])
+
+        for use_plan in (False, True):
+            timings = []
+            for i in range(options['repeat']):
+                ser = self.make_serializer(params, use_plan)
+                start_time = time.time()
+                ser.to_representation(units)
+                timings.append(time.time() - start_time)
+            best = min(timings)
+            print("%-10s %d units: best %.3f s (%.0f units/s)" % (
+                'plan' if use_plan else 'generic', len(units), best,
+                len(units) / best if best else 0))
+
+        values_plan = UnitValuesPlan.for_serializer(self.make_serializer(params, True).child)
+        if values_plan is None:
+            return
+        # Includes the query, unlike the timings above
+        timings = []
+        for i in range(options['repeat']):
+            start_time = time.time()
+            rows = values_plan.get_queryset(qs[:options['count']])
+            for row in rows:
+                values_plan.serialize_row(row)
+            timings.append(time.time() - start_time)
+        best = min(timings)
+        print("%-10s %d units: best %.3f s (%.0f units/s, including the query)" % (
+            'values', len(units), best, len(units) / best if best else 0))
@@ -9,15 +9,17 @@ from datetime import datetime
 from optparse import make_option
 import logging
 import hashlib
+import time
+import tempfile
 from pprint import pprint
 
-import requests
 import requests_cache
 import pytz
 from django.core.management.base import BaseCommand
 from django import db
 from django.conf import settings
 from django.db import transaction
+from django.db.models import Count
 from django.contrib.gis.geos import Point, Polygon
 from django.contrib.gis.gdal import SpatialReference, CoordTransform
 from django.utils.translation import activate, get_language
@@ -25,6 +27,11 @@ from django.utils.translation import activate, get_language
 from munigeo.models import Municipality
 from munigeo.importer.sync import ModelSyncher
 from services.models import *
+from services.service_tree import SERVICE_TREE_GENERATION
+from services.importer.http import PalvelukarttaClient
+from services.importer.stream import iter_chunks
+from services.importer.sync import LazyModelSyncher
+from services.importer.changeset import Changeset
 
 URL_BASE = 'http://www.hel.fi/palvelukarttaws/rest/v3/'
 GK25_SRID = 3879
@@ -49,11 +56,25 @@ SERVICE_IDS_TO_SKIP = set([
 
 SPORTS_MAINTENANCE_SERVICES = [33420,33418,33419,33417,33421,33467,33468]
 
+# Maximum number of rows touched by a single bulk UPDATE
+UPDATE_BATCH_SIZE = 1000
+
 class Command(BaseCommand):
     help = "Import services from Palvelukartta REST API"
     option_list = list(BaseCommand.option_list + (
         make_option('--cached', dest='cached', action='store_true', help='cache HTTP requests'),
-        make_option('--single', dest='single', action='store', metavar='ID', type='string', help='import only single entity'),
+        make_option('--single', dest='single', action='store', metavar='ID', type='string',
+                    help='import only single entity (or a comma-separated list of entities)'),
+        make_option('--delta', dest='delta', action='store_true',
+                    help='skip units whose source data has not changed since the last import'),
+        make_option('--changeset', dest='changeset', action='store', metavar='FILE',
+                    help='write the ids of created, changed and deleted units and services to FILE'),
+        make_option('--concurrency', dest='concurrency', action='store', metavar='N', type='int', default=4,
+                    help='number of parallel HTTP requests (default: 4)'),
+        make_option('--retries', dest='retries', action='store', metavar='N', type='int', default=3,
+                    help='number of times a failed HTTP request is retried (default: 3)'),
+        make_option('--chunk-size', dest='chunk_size', action='store', metavar='N', type='int', default=500,
+                    help='number of units processed per transaction (default: 500)'),
     ))
 
     importer_types = ['organizations', 'departments', 'services', 'units', 'aliases']
@@ -80,12 +101,44 @@ class Command(BaseCommand):
         return text
 
     def pk_get(self, resource_name, res_id=None):
-        url = "%s%s/" % (URL_BASE, resource_name)
-        if res_id != None:
-            url = "%s%s/" % (url, res_id)
-        resp = requests.get(url)
-        assert resp.status_code == 200
-        return resp.json()
+        if res_id is None and resource_name in self.prefetched:
+            return self.prefetched.pop(resource_name)
+        return self.http.get(resource_name, res_id)
+
+    def pk_stream(self, resource_name):
+        """
+        Like pk_get() for list resources, but decode the response
+        incrementally and yield the objects one at a time.
+        """
+        if resource_name in self.prefetched:
+            return iter(self.prefetched.pop(resource_name))
+        if resource_name in self.spooled:
+            return self._iter_spool(self.spooled.pop(resource_name))
+        return self.http.stream(resource_name)
+
+    def _iter_spool(self, spool):
+        with spool:
+            for line in spool:
+                yield json.loads(line)
+
+    def prefetch_resources(self):
+        """
+        Fetch the list resources needed by the selected importers
+        concurrently before the (sequential) import steps run.
+        """
+        resources = set()
+        if self.options['organizations']:
+            resources.add('organization')
+        if self.options['departments']:
+            resources.add('department')
+        if self.options['services']:
+            # The units needed for detecting duplicate services are
+            # streamed separately so that they are never all in memory.
+            resources.add('service')
+        if not resources:
+            return
+        tasks = {name: (lambda name=name: self.http.get(name)) for name in resources}
+        self.prefetched = self.http.run_parallel(tasks)
 
     def _save_translated_field(self, obj, obj_field_name, info, info_field_name, max_length=None):
         args = {}
@@ -120,11 +173,11 @@ class Command(BaseCommand):
 
     @db.transaction.atomic
     def import_organizations(self, noop=False):
-        obj_list = self.pk_get('organization')
         syncher = ModelSyncher(Organization.objects.all(), lambda obj: obj.id)
         self.org_syncher = syncher
         if noop:
             return
+        obj_list = self.pk_get('organization')
 
         for d in obj_list:
             obj = syncher.get(d['id'])
@@ -147,11 +200,11 @@ class Command(BaseCommand):
 
     @db.transaction.atomic
     def import_departments(self, noop=False):
-        obj_list = self.pk_get('department')
         syncher = ModelSyncher(Department.objects.all(), lambda obj: obj.id)
         self.dept_syncher = syncher
         if noop:
             return
+        obj_list = self.pk_get('department')
 
         for d in obj_list:
             obj = syncher.get(d['id'])
@@ -203,23 +256,15 @@ class Command(BaseCommand):
             srv['units'] = []
             srv['child_ids_dupes'] = srv['child_ids']
 
-        unit_list = self._fetch_units()
-
-        for unit in unit_list:
-            service_ids = unit.get('service_ids', [])
+        for unit_id, service_ids in self._fetch_unit_services():
             # Make note of what units supply each service. If the unit sets
             # and names for services match, we treat them as identical.
-            remove_ids = []
             for srv_id in sorted(service_ids):
                 if srv_id not in service_dict:
-                    self.logger.error("Service %d (in unit %d) not found" % (srv_id, unit['id']))
-                    remove_ids.append(srv_id)
+                    self.logger.error("Service %d (in unit %d) not found" % (srv_id, unit_id))
                     continue
                 srv = service_dict[srv_id]
-                srv['units'].append(unit['id'])
-
-            for srv_id in remove_ids:
-                service_ids.remove(srv_id)
+                srv['units'].append(unit_id)
 
         srv_by_name = {}
         for srv in service_list:
@@ -262,7 +307,8 @@ class Command(BaseCommand):
     @db.transaction.atomic
     def import_services(self):
         srv_list = self.pk_get('service')
-        syncher = ModelSyncher(Service.objects.exclude(pk__in=SERVICE_IDS_TO_SKIP), lambda obj: obj.id)
+        queryset = Service.objects.exclude(pk__in=SERVICE_IDS_TO_SKIP).prefetch_related('keywords')
+        syncher = ModelSyncher(queryset, lambda obj: obj.id)
 
         self.detect_duplicate_services(srv_list)
 
@@ -307,6 +353,9 @@ class Command(BaseCommand):
             if not obj:
                 obj = Service(id=d['id'])
                 obj._changed = True
+                obj._created = True
+            else:
+                obj._created = False
             self._save_translated_field(obj, 'name', d, 'name')
 
             if 'identical_to' in d:
@@ -337,10 +386,13 @@ class Command(BaseCommand):
             self._sync_searchwords(obj, d)
 
             if obj._changed:
-                obj.unit_count = obj.get_unit_count()
+                if obj.unit_count is None:
+                    # Recomputed for all services in update_unit_counts()
+                    obj.unit_count = 0
                 obj.last_modified_time = datetime.now(UTC_TIMEZONE)
                 obj.save()
                 self.services_changed = True
+                self.changeset.add('services.service', 'created' if obj._created else 'changed', obj.id)
             syncher.mark(obj)
 
         for d in additional_root_services:
@@ -348,50 +400,190 @@ class Command(BaseCommand):
         for d in srv_list:
             handle_service(d)
 
+        self._flush_searchwords()
+
         for obj, master_id in dupes:
             obj.identical_to_id = master_id
             obj.save(update_fields=['identical_to'])
+            self.services_changed = True
+            self.changeset.add('services.service', 'changed', obj.id)
 
-        syncher.finish()
+        deleted_ids = self._finish_syncher(syncher)
+        self.changeset.add_many('services.service', 'deleted', deleted_ids)
+        if deleted_ids:
+            self.services_changed = True
 
-    def _save_searchwords(self, obj, info, language):
-        field_name = 'extra_searchwords_%s' % language
-        if not field_name in info:
-            new_kw_set = set()
-        else:
-            kws = [x.strip() for x in info[field_name].split(',')]
-            kws = [x for x in kws if x]
-            new_kw_set = set()
-            for kw in kws:
-                if not kw in self.keywords[language]:
-                    kw_obj = Keyword(name=kw, language=language)
-                    kw_obj.save()
-                    self.keywords[language][kw] = kw_obj
-                    self.keywords_by_id[kw_obj.pk] = kw_obj
-                else:
-                    kw_obj = self.keywords[language][kw]
-                new_kw_set.add(kw_obj.pk)
+        if not self.services_changed:
+            # Keep the closure, the worker snapshots and everything
+            # keyed on the service tree generation valid
+            if self.verbosity:
+                print("No service changes, keeping the service tree closure")
+            return
+        if self.verbosity:
+            print("Rebuilding service tree closure...")
+        ServiceClosure.objects.rebuild()
+        DataGeneration.objects.bump(SERVICE_TREE_GENERATION)
 
-        obj.new_keywords |= new_kw_set
+    def _finish_syncher(self, syncher):
+        """
+        Finish the syncher and return the ids of the deleted objects.
+        """
+        if isinstance(syncher, LazyModelSyncher):
+            return syncher.finish()
+        deleted_ids = [obj_id for obj_id, obj in syncher.obj_dict.items() if not obj._found]
+        syncher.finish()
+        return deleted_ids
 
-    def _sync_searchwords(self, obj, info):
-        obj.new_keywords = set()
+    def _parse_searchwords(self, info):
+        kw_set = set()
         for lang in self.supported_languages:
-            self._save_searchwords(obj, info, lang)
+            field_name = 'extra_searchwords_%s' % lang
+            if not field_name in info:
+                continue
+            kws = [x.strip() for x in info[field_name].split(',')]
+            kw_set |= set((lang, x) for x in kws if x)
+        return kw_set
 
-        old_kw_set = set(obj.keywords.all().values_list('pk', flat=True))
-        if old_kw_set == obj.new_keywords:
+    def _sync_searchwords(self, obj, info):
+        """
+        Compare the keywords of obj with the ones in the source data and
+        queue the changes. The keywords are written in bulk with
+        _flush_searchwords().
+        """
+        new_kw_set = self._parse_searchwords(info)
+        old_kw_set = set((kw.language, kw.name) for kw in obj.keywords.all())
+        if old_kw_set == new_kw_set:
             return
 
         if self.verbosity:
-            old_kw_str = ', '.join([self.keywords_by_id[x].name for x in old_kw_set])
-            new_kw_str = ', '.join([self.keywords_by_id[x].name for x in obj.new_keywords])
+            old_kw_str = ', '.join(sorted(x[1] for x in old_kw_set))
+            new_kw_str = ', '.join(sorted(x[1] for x in new_kw_set))
             print("%s keyword set changed: %s -> %s" % (obj, old_kw_str, new_kw_str))
-        obj.keywords = list(obj.new_keywords)
+        self.pending_keywords.append((obj, new_kw_set))
         obj._changed = True
 
+    def _create_missing_keywords(self, kw_set):
+        missing = set(x for x in kw_set if x[1] not in self.keywords[x[0]])
+        if not missing:
+            return
+        Keyword.objects.bulk_create([Keyword(language=lang, name=name) for lang, name in missing])
+        # bulk_create() does not return primary keys, so read them back.
+        for lang in self.supported_languages:
+            names = [name for kw_lang, name in missing if kw_lang == lang]
+            if not names:
+                continue
+            for kw_obj in Keyword.objects.filter(language=lang, name__in=names):
+                self.keywords[lang][kw_obj.name] = kw_obj
+                self.keywords_by_id[kw_obj.pk] = kw_obj
+
+    def _flush_searchwords(self):
+        """
+        Apply the queued keyword changes with one bulk insert of new
+        keywords and one bulk insert and delete per M2M through table.
+        """
+        if not self.pending_keywords:
+            return
+        all_kws = set()
+        for obj, kw_set in self.pending_keywords:
+            all_kws |= kw_set
+        self._create_missing_keywords(all_kws)
+
+        by_model = {}
+        for obj, kw_set in self.pending_keywords:
+            kw_ids = set(self.keywords[lang][name].pk for lang, name in kw_set)
+            by_model.setdefault(type(obj), {})[obj.pk] = kw_ids
+
+        for model, new_by_obj in by_model.items():
+            through = model.keywords.through
+            obj_field = '%s_id' % model._meta.model_name
+            existing = through.objects.filter(**{'%s__in' % obj_field: list(new_by_obj.keys())})
+            delete_ids = []
+            old_by_obj = {}
+            for row_id, obj_id, kw_id in existing.values_list('id', obj_field, 'keyword_id'):
+                if kw_id in new_by_obj[obj_id]:
+                    old_by_obj.setdefault(obj_id, set()).add(kw_id)
+                else:
+                    delete_ids.append(row_id)
+            if delete_ids:
+                through.objects.filter(id__in=delete_ids).delete()
+
+            new_rows = []
+            for obj_id, kw_ids in new_by_obj.items():
+                for kw_id in kw_ids - old_by_obj.get(obj_id, set()):
+                    new_rows.append(through(**{obj_field: obj_id, 'keyword_id': kw_id}))
+            if new_rows:
+                through.objects.bulk_create(new_rows)
+
+        self.pending_keywords = []
+
+    def _reset_unit_relations(self):
+        self.relation_deletes = {UnitConnection: set(), UnitAccessibilityProperty: set(), UnitIdentifier: set()}
+        self.relation_creates = {UnitConnection: [], UnitAccessibilityProperty: [], UnitIdentifier: []}
+
+    def _flush_unit_relations(self):
+        for model, unit_ids in self.relation_deletes.items():
+            if unit_ids:
+                model.objects.filter(unit_id__in=unit_ids).delete()
+        for model, objs in self.relation_creates.items():
+            if objs:
+                model.objects.bulk_create(objs)
+        self._reset_unit_relations()
+
+    def _hash_json(self, data):
+        data_json = json.dumps(data, ensure_ascii=False, sort_keys=True).encode('utf8')
+        return hashlib.sha1(data_json).hexdigest()
+
+    def _get_import_context_hash(self):
+        """
+        Hash of the lookup tables shared by all units whose changes
+        must invalidate the stored content hashes.
+        """
+        return self._hash_json({
+            'municipalities': sorted((name, muni.id) for name, muni in self.muni_by_name.items()),
+            'postcodes': sorted(self.postcodes.items()),
+            'skipped_services': sorted(SERVICE_IDS_TO_SKIP),
+            'maintenance_services': sorted(SPORTS_MAINTENANCE_SERVICES),
+            'bounding_box': list(settings.BOUNDING_BOX),
+        })
+
+    def _hash_unit(self, info):
+        """
+        Hash the source data of a unit together with the inputs derived
+        from the rest of the import, so that e.g. a service appearing or
+        a department disappearing also counts as a change in --delta.
+        """
+        dept_id = info.get('dept_id')
+        derived = {
+            'context': self.import_context_hash,
+            'service_ids': sorted(x for x in info.get('service_ids', [])
+                                  if x in self.existing_service_ids),
+            'org': bool(self.org_syncher and self.org_syncher.get(info['org_id'])),
+            'dept': bool(dept_id and self.dept_syncher and self.dept_syncher.get(dept_id)),
+        }
+        return self._hash_json([info, derived])
+
     @db.transaction.atomic
-    def _import_unit(self, syncher, info):
+    def _import_unit_chunk(self, syncher, chunk):
+        pending = [(info, self._hash_unit(info)) for info in chunk]
+        if self.options['delta']:
+            # Skip units whose source data is unchanged before loading
+            # anything from the database.
+            changed = []
+            for info, content_hash in pending:
+                if self.unit_hashes.get(info['id']) == content_hash:
+                    syncher.mark_id(info['id'])
+                    self.unit_import_counts['unchanged'] += 1
+                else:
+                    changed.append((info, content_hash))
+            pending = changed
+        syncher.load([info['id'] for info, content_hash in pending])
+
+        for info, content_hash in pending:
+            self._import_unit(syncher, info, content_hash)
+        self._flush_unit_relations()
+        self._flush_searchwords()
+
+    def _import_unit(self, syncher, info, content_hash=None):
         obj = syncher.get(info['id'])
         if not obj:
             obj = Unit(id=info['id'])
@@ -549,6 +741,9 @@ class Command(BaseCommand):
             obj.origin_last_modified_time = datetime.now(UTC_TIMEZONE)
             obj._changed = False
             obj.save()
+            was_changed = True
+        else:
+            was_changed = False
 
         update_fields = ['origin_last_modified_time']
 
@@ -565,22 +760,20 @@ class Command(BaseCommand):
             for srv_id in service_ids:
                 self.count_services.add(srv_id)
 
-            # Update root service cache
-            obj.root_services = ','.join(str(x) for x in obj.get_root_services())
-            update_fields.append('root_services')
+            # Root service cache is updated in bulk after the import
+            self.root_service_units.add(obj.id)
             obj._changed = True
 
         self._sync_searchwords(obj, info)
 
         if info['connections']:
-            conn_json = json.dumps(info['connections'], ensure_ascii=False, sort_keys=True).encode('utf8')
-            conn_hash = hashlib.sha1(conn_json).hexdigest()
+            conn_hash = self._hash_json(info['connections'])
         else:
             conn_hash = None
         if obj.connection_hash != conn_hash:
             if self.verbosity:
                 self.logger.info("%s connection set changed (%s vs. %s)" % (obj, obj.connection_hash, conn_hash))
-            obj.connections.all().delete()
+            self.relation_deletes[UnitConnection].add(obj.id)
             for conn in info['connections']:
                 c = UnitConnection(unit=obj)
                 self._save_translated_field(c, 'name', conn, 'name', max_length=400)
@@ -598,52 +791,51 @@ class Command(BaseCommand):
                     if getattr(c, field) != val:
                         setattr(c, field, val)
                         c._changed = True
-                c.save()
+                self.relation_creates[UnitConnection].append(c)
             obj.connection_hash = conn_hash
             obj._changed = True
             update_fields.append('connection_hash')
 
         if info['accessibility_properties']:
-            acp_json = json.dumps(info['accessibility_properties'], ensure_ascii=False, sort_keys=True).encode('utf8')
-            acp_hash = hashlib.sha1(acp_json).hexdigest()
+            acp_hash = self._hash_json(info['accessibility_properties'])
         else:
             acp_hash = None
         if obj.accessibility_property_hash != acp_hash:
             if self.verbosity:
                 self.logger.info("%s accessibility property set changed (%s vs. %s)" %
                                  (obj, obj.accessibility_property_hash, acp_hash))
-            obj.accessibility_properties.all().delete()
+            self.relation_deletes[UnitAccessibilityProperty].add(obj.id)
             for acp in info['accessibility_properties']:
                 uap = UnitAccessibilityProperty(unit=obj)
                 var_id = acp['variable_id']
                 if var_id not in self.accessibility_variables:
                     var = AccessibilityVariable(id=var_id, name=acp['variable_name'])
                     var.save()
+                    self.accessibility_variables[var_id] = var
                 else:
                     var = self.accessibility_variables[var_id]
                 uap.variable = var
                 uap.value = acp['value']
-                uap.save()
+                self.relation_creates[UnitAccessibilityProperty].append(uap)
 
             obj.accessibility_property_hash = acp_hash
             obj._changed = True
             update_fields.append('accessibility_property_hash')
 
         if info['sources']:
-            id_json = json.dumps(info['sources'], ensure_ascii=False, sort_keys=True).encode('utf8')
-            id_hash = hashlib.sha1(id_json).hexdigest()
+            id_hash = self._hash_json(info['sources'])
         else:
             id_hash = None
         if obj.identifier_hash != id_hash:
             if self.verbosity:
                 self.logger.info("%s identifier set changed (%s vs. %s)" %
                                  (obj, obj.identifier_hash, id_hash))
-            obj.identifiers.all().delete()
+            self.relation_deletes[UnitIdentifier].add(obj.id)
             for uid in info['sources']:
                 ui = UnitIdentifier(unit=obj)
                 ui.namespace = uid.get('source')
                 ui.value = uid.get('id')
-                ui.save()
+                self.relation_creates[UnitIdentifier].append(ui)
 
             obj.identifier_hash = id_hash
             obj._changed = True
@@ -665,20 +857,50 @@ class Command(BaseCommand):
                     d[key] = val
         """
 
+        # The content hash is bookkeeping only and does not count as
+        # a modification of the unit.
+        hash_changed = content_hash is not None and obj.content_hash != content_hash
+        if hash_changed:
+            obj.content_hash = content_hash
+            update_fields.append('content_hash')
+
         if obj._changed:
             obj.origin_last_modified_time = datetime.now(UTC_TIMEZONE)
             obj.save(update_fields=update_fields)
+            was_changed = True
+        elif hash_changed:
+            obj.save(update_fields=['content_hash'])
+
+        if obj._created:
+            self.unit_import_counts['created'] += 1
+            self.changeset.add('services.unit', 'created', obj.id)
+        elif was_changed:
+            self.unit_import_counts['changed'] += 1
+            self.changeset.add('services.unit', 'changed', obj.id)
+        else:
+            self.unit_import_counts['unchanged'] += 1
 
         syncher.mark(obj)
 
-    def _fetch_units(self):
-        if hasattr(self, 'unit_list'):
-            return self.unit_list
+    def _fetch_unit_services(self):
+        """
+        Stream the units and yield only (id, service_ids) of each. If
+        the units are imported later in the run, the units are also
+        written to a temporary file, which import_units reads instead
+        of downloading them again.
+        """
         if self.verbosity:
-            self.logger.info("Fetching units")
-        obj_list = self.pk_get('unit')
-        self.unit_list = obj_list
-        return obj_list
+            self.logger.info("Fetching unit services")
+        spool = None
+        if self.options['units'] and not self.options['single']:
+            spool = tempfile.TemporaryFile(mode='w+', encoding='utf8')
+        for info in self.pk_stream('unit'):
+            if spool is not None:
+                spool.write(json.dumps(info) + '\n')
+            yield info['id'], info.get('service_ids', [])
+        if spool is not None:
+            spool.seek(0)
+            self.spooled['unit'] = spool
 
     def _load_postcodes(self):
         path = os.path.join(settings.BASE_DIR, 'data', 'fi', 'postcodes.txt')
@@ -692,6 +914,14 @@ class Command(BaseCommand):
             self.postcodes[code] = muni.strip()
 
     def import_units(self):
+        """
+        Import the units while streaming them from the API, one chunk
+        (--chunk-size) at a time. What is still held in memory for the
+        whole run: the connections and accessibility properties of all
+        units grouped by unit (freed unit by unit as they are attached),
+        the ids of the existing units and, with --delta, their content
+        hashes. Unit objects only exist for the current chunk.
+        """
         self._load_postcodes()
         self.muni_by_name = {muni.name_fi.lower(): muni for muni in Municipality.objects.all()}
         if self.existing_service_ids == None or len(self.existing_service_ids) < 1:
@@ -702,26 +932,24 @@ class Command(BaseCommand):
         if not getattr(self, 'dept_syncher', None):
             self.import_departments(noop=True)
 
-        if self.verbosity:
-            self.logger.info("Fetching unit connections")
-        connections = self.pk_get('connection')
-        conn_by_unit = {}
-        for conn in connections:
-            unit_id = conn['unit_id']
-            if unit_id not in conn_by_unit:
-                conn_by_unit[unit_id] = []
-            conn_by_unit[unit_id].append(conn)
+        def group_by_unit(resource_name):
+            by_unit = {}
+            for obj in self.pk_stream(resource_name):
+                unit_id = obj['unit_id']
+                if unit_id not in by_unit:
+                    by_unit[unit_id] = []
+                by_unit[unit_id].append(obj)
+            return by_unit
 
-        self.accessibility_variables = {x.id: x for x in AccessibilityVariable.objects.all()}
         if self.verbosity:
-            self.logger.info("Fetching accessibility properties")
-        acc_properties = self.pk_get('accessibility_property')
-        acc_by_unit = {}
-        for ap in acc_properties:
-            unit_id = ap['unit_id']
-            if unit_id not in acc_by_unit:
-                acc_by_unit[unit_id] = []
-            acc_by_unit[unit_id].append(ap)
+            self.logger.info("Fetching unit connections and accessibility properties")
+        grouped = self.http.run_parallel({
+            'connection': lambda: group_by_unit('connection'),
+            'accessibility_property': lambda: group_by_unit('accessibility_property'),
+        })
+        conn_by_unit = grouped['connection']
+        acc_by_unit = grouped['accessibility_property']
+        self.accessibility_variables = {x.id: x for x in AccessibilityVariable.objects.all()}
 
         self.target_srid = PROJECTION_SRID
         self.bounding_box = Polygon.from_bbox(settings.BOUNDING_BOX)
@@ -733,21 +961,38 @@ class Command(BaseCommand):
         self.gps_to_target_ct = CoordTransform(gps_srs, target_srs)
 
         if self.options['single']:
-            obj_id = self.options['single']
-            obj_list = [self.pk_get('unit', obj_id)]
-            queryset = Unit.objects.filter(id=obj_id)
+            obj_ids = [x.strip() for x in self.options['single'].split(',') if x.strip()]
+            obj_list = self.http.get_many('unit', obj_ids)
+            queryset = Unit.objects.filter(id__in=obj_ids)
         else:
-            obj_list = self._fetch_units()
+            if self.verbosity:
+                self.logger.info("Fetching units")
+            obj_list = self.pk_stream('unit')
             queryset = Unit.objects.filter(data_source='tprek').prefetch_related('services', 'keywords')
 
-        syncher = ModelSyncher(queryset, lambda obj: obj.id)
-        for idx, info in enumerate(obj_list):
-            conn_list = conn_by_unit.get(info['id'], [])
-            info['connections'] = conn_list
-            acp_list = acc_by_unit.get(info['id'], [])
-            info['accessibility_properties'] = acp_list
-            self._import_unit(syncher, info)
-        syncher.finish()
+        def attach_relations(obj_list):
+            for info in obj_list:
+                info['connections'] = conn_by_unit.pop(info['id'], [])
+                info['accessibility_properties'] = acc_by_unit.pop(info['id'], [])
+                yield info
+
+        self.unit_import_counts = {'created': 0, 'changed': 0, 'unchanged': 0}
+        self.import_context_hash = self._get_import_context_hash()
+        if self.options['delta']:
+            self.unit_hashes = dict(queryset.values_list('id', 'content_hash'))
+        # Existing units are loaded one chunk at a time in both modes
+        syncher = LazyModelSyncher(queryset)
+        self._reset_unit_relations()
+        for chunk in iter_chunks(attach_relations(obj_list), self.options['chunk_size']):
+            self._import_unit_chunk(syncher, chunk)
+        self.changeset.add_many('services.unit', 'deleted', self._finish_syncher(syncher))
+
+        if self.verbosity:
+            print("Units: %(created)d created, %(changed)d changed, %(unchanged)d unchanged" %
+                  self.unit_import_counts)
+
+        if self.root_service_units:
+            self.update_root_services(unit_ids=self.root_service_units)
 
     def import_aliases(self):
         path = os.path.join(settings.BASE_DIR, 'data', 'school_ids.csv')
@@ -791,31 +1036,68 @@ class Command(BaseCommand):
             print("Skipped {} aliases already in database.".format(counts['duplicate']))
 
     @db.transaction.atomic
-    def update_root_services(self):
+    def update_root_services(self, unit_ids=None):
+        """
+        Recompute the cached root services of units from a single join
+        of the unit-service M2M with the service tree. If unit_ids is
+        given, only those units are updated.
+        """
         if self.verbosity:
             print("Updating unit root services...")
-        for unit in Unit.objects.all().only('id', 'root_services'):
-            new_srv_list = ','.join([str(x) for x in unit.get_root_services()])
-            if new_srv_list != unit.root_services:
-                unit.root_services = new_srv_list
-                unit.save(update_fields=['root_services'])
+        root_by_tree = dict(Service.objects.filter(level=0).values_list('tree_id', 'id'))
+        units = Unit.objects.all()
+        unit_services = Unit.services.through.objects.all()
+        if unit_ids is not None:
+            unit_ids = list(unit_ids)
+            units = units.filter(id__in=unit_ids)
+            unit_services = unit_services.filter(unit_id__in=unit_ids)
+
+        roots_by_unit = {}
+        for unit_id, tree_id in unit_services.values_list('unit_id', 'service__tree_id'):
+            roots_by_unit.setdefault(unit_id, set()).add(root_by_tree[tree_id])
+
+        changed_by_value = {}
+        for unit_id, old_value in units.values_list('id', 'root_services'):
+            new_value = ','.join(str(x) for x in sorted(roots_by_unit.get(unit_id, [])))
+            if new_value != old_value:
+                changed_by_value.setdefault(new_value, []).append(unit_id)
+
+        changed = 0
+        now = datetime.now(UTC_TIMEZONE)
+        for value, ids in changed_by_value.items():
+            for i in range(0, len(ids), UPDATE_BATCH_SIZE):
+                # Move the modified time like saving the unit would, for the
+                # API validators, --delta and the search index updates
+                Unit.objects.filter(id__in=ids[i:i + UPDATE_BATCH_SIZE]).update(
+                    root_services=value, origin_last_modified_time=now)
+            # Root services are indexed for faceting
+            self.changeset.add_many('services.unit', 'changed', ids)
+            changed += len(ids)
+        if self.verbosity:
+            print("Root services changed for %d units" % changed)
 
     @db.transaction.atomic
     def update_unit_counts(self):
-        srv_set = self.count_services
-        current_set = srv_set
-        for i in range(0, 20): # Make sure we don't loop endlessly (shouldn't have 20 deep tree anyway)
-            parent_ids = Service.objects.filter(id__in=current_set).values_list('parent', flat=True)
-            if not parent_ids:
-                break
-            srv_set |= set(parent_ids)
-            current_set = parent_ids
         if self.verbosity:
-            print("Updating unit counts for %d services..." % len(srv_set))
-        srv_list = Service.objects.filter(id__in=srv_set)
-        for srv in srv_list:
-            srv.unit_count = srv.get_unit_count()
-            srv.save(update_fields=['unit_count'])
+            print("Updating unit counts...")
+        start_time = time.time()
+        # The unit count of a service includes the units of all its
+        # descendants, so count distinct units over the closure table.
+        new_counts = (ServiceClosure.objects.values_list('ancestor_id')
+                      .annotate(count=Count('descendant__units', distinct=True)))
+        old_counts = dict(Service.objects.values_list('id', 'unit_count'))
+
+        changed_by_count = {}
+        for srv_id, count in new_counts:
+            if old_counts.get(srv_id) != count:
+                changed_by_count.setdefault(count, []).append(srv_id)
+        for count, srv_ids in changed_by_count.items():
+            Service.objects.filter(id__in=srv_ids).update(unit_count=count)
+
+        if self.verbosity:
+            changed = sum(len(x) for x in changed_by_count.values())
+            print("Unit counts updated for %d services (%d changed) in %.2f s" % (
+                len(old_counts), changed, time.time() - start_time))
 
     @db.transaction.atomic
     def update_division_units(self):
@@ -844,15 +1126,25 @@ class Command(BaseCommand):
         self.logger = logging.getLogger(__name__)
         self.services_changed = False
         self.count_services = set()
+        self.root_service_units = set()
         self.keywords = {}
         for lang in self.supported_languages:
             kw_list = Keyword.objects.filter(language=lang)
             kw_dict = {kw.name: kw for kw in kw_list}
             self.keywords[lang] = kw_dict
         self.keywords_by_id = {kw.pk: kw for kw in Keyword.objects.all()}
+        self.pending_keywords = []
+        self.changeset = Changeset()
 
         if options['cached']:
             requests_cache.install_cache('services_import')
+        # Created after installing the cache, which patches the session class
+        self.http = PalvelukarttaClient(URL_BASE, concurrency=options['concurrency'],
+                                        retries=options['retries'])
+        self.prefetched = {}
+        # Resources already streamed once during the run, kept on disk
+        self.spooled = {}
+        self.prefetch_resources()
 
         # Activate the default language for the duration of the import
         # to make sure translated fields are populated correctly.
@@ -871,10 +1163,16 @@ class Command(BaseCommand):
 
         if self.services_changed:
             self.update_root_services()
-        if self.count_services:
+        if self.services_changed or self.count_services:
             self.update_unit_counts()
         self.update_division_units()
 
         if not import_count:
             sys.stderr.write("Nothing to import.\n")
+        elif self.verbosity:
+            print("HTTP fetch times:\n%s" % self.http.format_timings())
+        if options['changeset']:
+            self.changeset.save(options['changeset'])
+            if self.verbosity:
+                print("Wrote %d changes to %s" % (self.changeset.count(), options['changeset']))
         activate(old_lang)
@@ -0,0 +1,46 @@
+import time
+from optparse import make_option
+
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from haystack import connections
+from haystack.constants import DEFAULT_ALIAS
+
+from services.importer.stream import iter_queryset_chunks
+
+
+class Command(BaseCommand):
+    help = "Index all addresses, paging through the table by primary key"
+
+    option_list = list(BaseCommand.option_list + (
+        make_option('-b', '--batch-size', dest='batch_size', type='int', default=5000,
+                    help='number of addresses to index at a time'),
+        make_option('-u', '--using', dest='using', default=DEFAULT_ALIAS,
+                    help='search connection to update'),
+        make_option('--start-after', dest='start_after', type='int',
+                    help='resume after the address with this id'),
+    ))
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        using = options['using']
+        backend = connections[using].get_backend()
+        index = connections[using].get_unified_index().get_index(apps.get_model('munigeo', 'Address'))
+
+        qs = index.build_queryset(using=using)
+        if options['start_after']:
+            qs = qs.filter(pk__gt=options['start_after'])
+        total = qs.count()
+
+        count = 0
+        start_time = time.time()
+        for chunk in iter_queryset_chunks(qs, options['batch_size']):
+            backend.update(index, chunk)
+            count += len(chunk)
+            if verbosity:
+                elapsed = time.time() - start_time
+                print("%d/%d addresses indexed (last id %d, %.1f addresses/s)" % (
+                    count, total, chunk[-1].pk, count / elapsed if elapsed else 0))
+
+        if verbosity:
+            print("Indexed %d addresses in %.2f s" % (count, time.time() - start_time))
@@ -0,0 +1,71 @@
+from optparse import make_option
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from haystack import connections
+from haystack.constants import DEFAULT_ALIAS
+from haystack.exceptions import NotHandled
+
+from services.importer.changeset import Changeset
+from services.importer.stream import iter_chunks
+from services.models import DataGeneration
+from services.search_indexes import SEARCH_INDEX_GENERATION
+
+
+class Command(BaseCommand):
+    help = "Update the search index for the objects listed in an importer changeset file"
+    args = '<changeset file>'
+
+    option_list = list(BaseCommand.option_list + (
+        make_option('-b', '--batch-size', dest='batch_size', type='int', default=1000,
+                    help='number of objects to index at a time'),
+        make_option('-u', '--using', dest='using', default=DEFAULT_ALIAS,
+                    help='search connection to update'),
+    ))
+
+    def update_model(self, label, changeset):
+        model = apps.get_model(label)
+        try:
+            index = self.unified_index.get_index(model)
+        except NotHandled:
+            if self.verbosity:
+                print("%s is not indexed, skipping" % label)
+            return
+
+        updated_ids = changeset.get(label, 'created') | changeset.get(label, 'changed')
+        removed_ids = set(changeset.get(label, 'deleted'))
+        indexed_count = 0
+        for batch in iter_chunks(sorted(updated_ids), self.options['batch_size']):
+            qs = index.build_queryset(using=self.using).filter(pk__in=batch)
+            objs = list(qs)
+            if objs:
+                self.backend.update(index, objs)
+                indexed_count += len(objs)
+            # Objects dropped out of the index queryset (e.g. services that
+            # became duplicates) have to be removed from the index.
+            found_ids = set(obj.pk for obj in objs)
+            removed_ids.update(obj_id for obj_id in batch if obj_id not in found_ids)
+
+        for obj_id in sorted(removed_ids):
+            self.backend.remove('%s.%s' % (label, obj_id))
+
+        if self.verbosity:
+            print("%s: %d indexed, %d removed" % (label, indexed_count, len(removed_ids)))
+        return indexed_count + len(removed_ids)
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Give the path of the changeset file")
+        self.options = options
+        self.verbosity = int(options.get('verbosity', 1))
+        self.using = options['using']
+        self.backend = connections[self.using].get_backend()
+        self.unified_index = connections[self.using].get_unified_index()
+
+        changeset = Changeset.load(args[0])
+        changed_count = 0
+        for label in changeset.labels():
+            changed_count += self.update_model(label, changeset) or 0
+
+        if changed_count:
+            DataGeneration.objects.bump(SEARCH_INDEX_GENERATION)
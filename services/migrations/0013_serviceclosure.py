@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def populate_closure(apps, schema_editor):
+    Service = apps.get_model('services', 'Service')
+    ServiceClosure = apps.get_model('services', 'ServiceClosure')
+    schema_editor.execute(
+        "INSERT INTO {closure} (ancestor_id, descendant_id, depth) "
+        "SELECT a.id, d.id, d.level - a.level "
+        "FROM {service} a INNER JOIN {service} d "
+        "ON d.tree_id = a.tree_id AND d.lft >= a.lft AND d.rght <= a.rght".format(
+            closure=ServiceClosure._meta.db_table, service=Service._meta.db_table))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('services', '0012_unit_data_source'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ServiceClosure',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', auto_created=True, primary_key=True, serialize=False)),
+                ('depth', models.PositiveSmallIntegerField()),
+                ('ancestor', models.ForeignKey(to='services.Service', related_name='descendant_links')),
+                ('descendant', models.ForeignKey(to='services.Service', related_name='ancestor_links')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='serviceclosure',
+            unique_together=set([('ancestor', 'descendant')]),
+        ),
+        migrations.RunPython(populate_closure, migrations.RunPython.noop),
+    ]
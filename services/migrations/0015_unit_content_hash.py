@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('services', '0014_datageneration'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='unit',
+            name='content_hash',
+            field=models.CharField(null=True, max_length=40, help_text='Automatically generated hash of the imported unit data'),
+        ),
+    ]
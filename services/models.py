@@ -3,8 +3,10 @@ from django.db.models.query import QuerySet
 
 from django.utils.encoding import python_2_unicode_compatible
 from mptt.models import MPTTModel, TreeForeignKey, TreeManager
+from mptt.querysets import TreeQuerySet
 from django.conf import settings
 from django.db.models import Q
+from django.db import transaction
 
 from django.contrib.postgres.fields import HStoreField
 
@@ -49,21 +51,22 @@ class Keyword(models.Model):
         return "%s (%s)" % (self.name, self.language)
 
 
-class ServiceQuerySet(QuerySet):
+class ServiceQuerySet(TreeQuerySet):
     def by_ancestor(self, ancestor):
-        manager = self.model.objects
-        max_level = manager.determine_max_level()
-        qs = Q()
-        # Construct an OR'd queryset for each level of parenthood.
-        for i in range(max_level):
-            key = '__'.join(['parent'] * (i + 1))
-            qs |= Q(**{key: ancestor})
-        return self.filter(qs)
-
-class ServiceManager(TreeManager):
-    def get_queryset(self):
-        return ServiceQuerySet(self.model, using=self._db)
-
+        return self.by_ancestors([ancestor])
+
+    def by_ancestors(self, ancestors, include_self=False):
+        """
+        Filter to services below any of the given ancestors. The lookup
+        is done against the ServiceClosure table, so it is a single
+        subquery regardless of the depth of the tree.
+        """
+        links = ServiceClosure.objects.filter(ancestor__in=ancestors)
+        if not include_self:
+            links = links.filter(depth__gt=0)
+        return self.filter(id__in=links.values('descendant_id'))
+
+class ServiceManager(TreeManager.from_queryset(ServiceQuerySet)):
     def determine_max_level(self):
         if hasattr(self, '_max_level'):
             return self._max_level
@@ -93,9 +96,76 @@ class Service(MPTTModel):
         return "%s (%s)" % (get_translated(self, 'name'), self.id)
 
     def get_unit_count(self):
-        srv_list = set(Service.objects.all().by_ancestor(self).values_list('id', flat=True))
-        srv_list.add(self.id)
-        return Unit.objects.filter(services__in=list(srv_list)).distinct().count()
+        srv_qs = Service.objects.by_ancestors([self], include_self=True)
+        return Unit.objects.filter(services__in=srv_qs).distinct().count()
+
+
+class ServiceClosureManager(models.Manager):
+    def rebuild(self):
+        """
+        Regenerate the whole closure table from the MPTT fields of
+        the service tree. Every service is linked to itself (depth 0)
+        and to all of its descendants.
+        """
+        service_table = Service._meta.db_table
+        closure_table = self.model._meta.db_table
+        with transaction.atomic(using=self.db):
+            cursor = django.db.connections[self.db].cursor()
+            cursor.execute("DELETE FROM %s" % closure_table)
+            cursor.execute(
+                "INSERT INTO {closure} (ancestor_id, descendant_id, depth) "
+                "SELECT a.id, d.id, d.level - a.level "
+                "FROM {service} a INNER JOIN {service} d "
+                "ON d.tree_id = a.tree_id AND d.lft >= a.lft AND d.rght <= a.rght".format(
+                    closure=closure_table, service=service_table))
+
+
+class ServiceClosure(models.Model):
+    """
+    Materialized ancestor/descendant pairs of the service tree.
+    Refreshed by the importer after services have been imported.
+    """
+    ancestor = models.ForeignKey(Service, related_name='descendant_links')
+    descendant = models.ForeignKey(Service, related_name='ancestor_links')
+    depth = models.PositiveSmallIntegerField()
+
+    objects = ServiceClosureManager()
+
+    class Meta:
+        unique_together = (('ancestor', 'descendant'),)
+
+
+class DataGenerationManager(models.Manager):
+    def current(self, name):
+        try:
+            return self.get(name=name).generation
+        except self.model.DoesNotExist:
+            return 0
+
+    def bump(self, name):
+        """
+        Increment the named generation counter, creating it if needed.
+        """
+        with transaction.atomic(using=self.db):
+            obj, created = self.select_for_update().get_or_create(name=name)
+            obj.generation += 1
+            obj.save(update_fields=['generation'])
+        return obj.generation
+
+
+@python_2_unicode_compatible
+class DataGeneration(models.Model):
+    """
+    Counters bumped by the importers whenever the named data set changes.
+    In-process caches compare against these to notice when they are stale.
+    """
+    name = models.CharField(max_length=50, primary_key=True)
+    generation = models.PositiveIntegerField(default=0)
+
+    objects = DataGenerationManager()
+
+    def __str__(self):
+        return "%s (%d)" % (self.name, self.generation)
 
 
 @python_2_unicode_compatible
@@ -117,16 +187,6 @@ class Department(models.Model):
     def __str__(self):
         return "%s (%s)" % (get_translated(self, 'name'), self.id)
 
-class UnitSearchManager(models.GeoManager):
-    def get_queryset(self):
-        qs = super(UnitSearchManager, self).get_queryset()
-        if self.only_fields:
-            qs = qs.only(*self.only_fields)
-        if self.include_fields:
-            for f in self.include_fields:
-                qs = qs.prefetch_related(f)
-        return qs
-
 @python_2_unicode_compatible
 class Unit(models.Model):
     id = models.IntegerField(primary_key=True)
@@ -167,12 +227,13 @@ class Unit(models.Model):
         help_text='Automatically generated hash of accessibility property info')
     identifier_hash = models.CharField(max_length=40, null=True,
         help_text='Automatically generated hash of other identifiers')
+    content_hash = models.CharField(max_length=40, null=True,
+        help_text='Automatically generated hash of the imported unit data')
 
     # Cached fields for better performance
     root_services = models.CommaSeparatedIntegerField(max_length=50, null=True)
 
     objects = models.GeoManager()
-    search_objects = UnitSearchManager()
 
     def __str__(self):
         return "%s (%s)" % (get_translated(self, 'name'), self.id)
@@ -0,0 +1,133 @@
+"""
+Response cache for the search endpoint.
+
+Autocomplete traffic repeats the same prefixes over and over, so search
+responses are cached under their normalized query parameters. Each
+process keeps a bounded LRU of recent responses; optionally responses
+are also stored in a shared Django cache (SEARCH_CACHE_ALIAS) so that
+all workers benefit. The cache keys include the search index generation,
+so entries are invalidated when update_index_changeset bumps it.
+"""
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.utils.encoders import JSONEncoder
+
+from services.models import DataGeneration
+from services.search_indexes import SEARCH_INDEX_GENERATION
+
+# Maximum number of responses kept in each process
+CACHE_SIZE = getattr(settings, 'SEARCH_CACHE_SIZE', 1000)
+# Seconds a response is kept in either tier
+CACHE_TIMEOUT = getattr(settings, 'SEARCH_CACHE_TIMEOUT', 300)
+# Django cache alias for the shared tier, None to disable it
+CACHE_ALIAS = getattr(settings, 'SEARCH_CACHE_ALIAS', None)
+# How often (in seconds) the index generation is checked
+CHECK_INTERVAL = getattr(settings, 'SEARCH_CACHE_CHECK_INTERVAL', 10)
+
+# Parameters holding comma-separated lists whose order does not matter
+LIST_PARAMS = ('type', 'municipality', 'service', 'only', 'include')
+# Parameters holding free text
+TEXT_PARAMS = ('input', 'q')
+# Parameters that do not affect the response data
+IGNORED_PARAMS = ('callback', 'format', '_')
+
+
+def normalize_params(query_params, default_language):
+    params = {}
+    for name in query_params.keys():
+        if name in IGNORED_PARAMS:
+            continue
+        val = query_params.get(name, '').strip()
+        if name in LIST_PARAMS:
+            val = ','.join(sorted(set(x.strip().lower() for x in val.split(',') if x.strip())))
+        elif name in TEXT_PARAMS:
+            val = ' '.join(val.lower().split())
+        if val:
+            params[name] = val
+    params.setdefault('language', default_language)
+    return params
+
+
+class SearchResponseCache(object):
+    def __init__(self, size=CACHE_SIZE, timeout=CACHE_TIMEOUT, alias=CACHE_ALIAS):
+        self.size = size
+        self.timeout = timeout
+        self.alias = alias
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self._generation = None
+        self._last_check = 0
+        self._lock = threading.Lock()
+
+    def get_generation(self):
+        now = time.time()
+        if self._generation is None or now - self._last_check >= CHECK_INTERVAL:
+            self._generation = DataGeneration.objects.current(SEARCH_INDEX_GENERATION)
+            self._last_check = now
+        return self._generation
+
+    def make_key(self, request, default_language):
+        params = normalize_params(request.query_params, default_language)
+        # The host is part of the pagination links
+        data = [self.get_generation(), request.get_host(), sorted(params.items())]
+        digest = hashlib.sha1(json.dumps(data).encode('utf8')).hexdigest()
+        return 'search:%s' % digest
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                stored_at, data = entry
+                if now - stored_at < self.timeout:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return data
+                del self.entries[key]
+
+        if self.alias:
+            data = caches[self.alias].get(key)
+            if data is not None:
+                self._store(key, data, now)
+                with self._lock:
+                    self.shared_hits += 1
+                return data
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _store(self, key, data, now):
+        with self._lock:
+            self.entries[key] = (now, data)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def set(self, key, data):
+        # Store plain JSON data, detached from the serializers
+        data = json.loads(json.dumps(data, cls=JSONEncoder), object_pairs_hook=OrderedDict)
+        self._store(key, data, time.time())
+        if self.alias:
+            caches[self.alias].set(key, data, self.timeout)
+
+    def get_stats(self):
+        with self._lock:
+            return OrderedDict([
+                ('size', len(self.entries)),
+                ('max_size', self.size),
+                ('hits', self.hits),
+                ('shared_hits', self.shared_hits),
+                ('misses', self.misses),
+            ])
+
+
+search_cache = SearchResponseCache()
@@ -3,6 +3,9 @@ from django.utils.translation import get_language
 from django.db import models
 from django.apps import apps
 
+# Bumped whenever the search index contents change
+SEARCH_INDEX_GENERATION = 'search_index'
+
 
 class DeleteOnlySignalProcessor(signals.BaseSignalProcessor):
     """
@@ -34,7 +37,10 @@ class ServiceMapBaseIndex(indexes.SearchIndex, indexes.Indexable):
         return self.model
 
     def _prepare_extra_searchwords(self, obj):
-        return ' '.join([category.name for category in obj.keywords.filter(language=get_language())])
+        # Filter in Python so that prefetched keywords are used
+        language = get_language()
+        return ' '.join([category.name for category in obj.keywords.all()
+                         if category.language == language])
 
     def prepare_extra_searchwords(self, obj):
         return self._prepare_extra_searchwords(obj)
@@ -44,11 +50,10 @@ class ServiceMapBaseIndex(indexes.SearchIndex, indexes.Indexable):
 
 
 class UnitIndex(ServiceMapBaseIndex):
-    municipality = indexes.CharField(model_attr='municipality_id', null=True)
+    municipality = indexes.CharField(model_attr='municipality_id', null=True, faceted=True)
     services = indexes.MultiValueField()
-
-    def read_queryset(self, using=None):
-        return self.get_model().search_objects
+    root_services = indexes.MultiValueField(faceted=True)
+    location = indexes.LocationField(null=True)
 
     def __init__(self, *args, **kwargs):
         super(*args, **kwargs)
@@ -57,9 +62,24 @@ class UnitIndex(ServiceMapBaseIndex):
     def get_updated_field(self):
         return 'origin_last_modified_time'
 
+    def index_queryset(self, using=None):
+        qs = self.get_model().objects.select_related('municipality', 'department')
+        return qs.prefetch_related('keywords', 'services')
+
     def prepare_services(self, obj):
         return [service.id for service in obj.services.all()]
 
+    def prepare_root_services(self, obj):
+        if not obj.root_services:
+            return []
+        return [int(x) for x in obj.root_services.split(',')]
+
+    def prepare_location(self, obj):
+        if obj.location is None:
+            return None
+        location = obj.location.transform(4326, clone=True)
+        return "%s,%s" % (location.y, location.x)
+
 class ServiceIndex(ServiceMapBaseIndex):
 
     def __init__(self, *args, **kwargs):
@@ -70,7 +90,7 @@ class ServiceIndex(ServiceMapBaseIndex):
         return 'last_modified_time'
 
     def index_queryset(self, using=None):
-        return self.get_model().objects.filter(identical_to=None)
+        return self.get_model().objects.filter(identical_to=None).prefetch_related('keywords')
 
     # def prepare(self, obj):
     #     obj.lang_keywords = obj.keywords.filter(language=get_language())
@@ -87,6 +107,10 @@ class AddressIndex(indexes.SearchIndex, indexes.Indexable):
     def get_model(self):
         return apps.get_model('munigeo', 'Address')
 
+    def index_queryset(self, using=None):
+        # The address string is built from the street and its municipality
+        return self.get_model().objects.select_related('street__municipality')
+
     def prepare_text(self, obj):
         return ''
 
@@ -0,0 +1,86 @@
+"""
+In-process snapshot of the service tree.
+
+The service tree is small and only changes when services are imported,
+so instead of querying the database for parents and roots while
+serializing, each worker keeps an immutable copy of the tree in memory.
+The importer bumps the SERVICE_TREE_GENERATION counter and workers
+reload their snapshot once they notice the new generation.
+"""
+import threading
+import time
+from collections import namedtuple
+
+from django.conf import settings
+
+from services.models import Service, DataGeneration
+
+SERVICE_TREE_GENERATION = 'service_tree'
+
+LANGUAGES = [x[0] for x in settings.LANGUAGES]
+
+# How often (in seconds) the generation counter is checked
+CHECK_INTERVAL = getattr(settings, 'SERVICE_TREE_CHECK_INTERVAL', 10)
+
+ServiceNode = namedtuple('ServiceNode', [
+    'id', 'parent_id', 'root_id', 'level', 'name', 'identical_to_id'
+])
+
+
+class ServiceTreeSnapshot(object):
+    def __init__(self, generation, nodes):
+        self.generation = generation
+        self.nodes = nodes
+
+    @classmethod
+    def load(cls, generation):
+        name_fields = ['name_%s' % lang for lang in LANGUAGES]
+        fields = ['id', 'parent_id', 'tree_id', 'level', 'identical_to_id'] + name_fields
+        rows = list(Service.objects.values_list(*fields))
+
+        root_by_tree = {row[2]: row[0] for row in rows if row[3] == 0}
+        nodes = {}
+        for row in rows:
+            srv_id, parent_id, tree_id, level, identical_to_id = row[:5]
+            name = dict(zip(LANGUAGES, row[5:]))
+            nodes[srv_id] = ServiceNode(
+                srv_id, parent_id, root_by_tree.get(tree_id), level, name, identical_to_id)
+        return cls(generation, nodes)
+
+    def get(self, service_id):
+        return self.nodes.get(service_id)
+
+    def root_id(self, service_id):
+        node = self.nodes.get(service_id)
+        if node is None:
+            return None
+        return node.root_id
+
+
+_snapshot = None
+_last_check = 0
+_lock = threading.Lock()
+
+
+def get_service_tree():
+    """
+    Return the current service tree snapshot, reloading it if the
+    importer has bumped the generation since it was loaded.
+    """
+    global _snapshot, _last_check
+
+    now = time.time()
+    snapshot = _snapshot
+    if snapshot is not None and now - _last_check < CHECK_INTERVAL:
+        return snapshot
+
+    with _lock:
+        if _snapshot is not snapshot:
+            # Another thread reloaded while we were waiting
+            return _snapshot
+        generation = DataGeneration.objects.current(SERVICE_TREE_GENERATION)
+        if snapshot is None or snapshot.generation != generation:
+            snapshot = ServiceTreeSnapshot.load(generation)
+            _snapshot = snapshot
+        _last_check = now
+    return snapshot
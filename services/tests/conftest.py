@@ -0,0 +1,134 @@
+import json
+import threading
+import pytest
+import datetime as d
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from django.contrib.gis.geos import Point
+from django.db import connection
+from haystack import connections as haystack_connections
+from munigeo.models import Municipality
+from services.models import Keyword, Organization, Service, ServiceClosure, Unit
+from services.search_cache import search_cache
+
+
+@pytest.fixture
+def service_tree():
+    def create(id, parent=None):
+        return Service.objects.create(
+            id=id, name='service %d' % id, parent=parent,
+            unit_count=0, last_modified_time=d.datetime.now())
+    root = create(1)
+    child = create(2, root)
+    grandchild = create(3, child)
+    other_root = create(4)
+    ServiceClosure.objects.rebuild()
+    return {'root': root, 'child': child, 'grandchild': grandchild, 'other_root': other_root}
+
+
+class PalvelukarttaStandIn(object):
+    """
+    Minimal local stand-in for the Palvelukartta REST API. Serves
+    the JSON documents in `resources` keyed by path, e.g. 'unit/'.
+    A path listed in `failures` answers 503 that many times first.
+    """
+    def __init__(self):
+        self.resources = {}
+        self.failures = {}
+        self.requests = []
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.lstrip('/')
+                stand_in.requests.append(path)
+                if stand_in.failures.get(path):
+                    stand_in.failures[path] -= 1
+                    self.send_response(503)
+                    self.end_headers()
+                    return
+                if path not in stand_in.resources:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = json.dumps(stand_in.resources[path]).encode('utf8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        self.base_url = 'http://127.0.0.1:%d/' % self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def palvelukartta_server(request):
+    server = PalvelukarttaStandIn()
+    request.addfinalizer(server.close)
+    return server
+
+
+@pytest.fixture
+def postgres_search(settings, monkeypatch):
+    """
+    Use the PostgreSQL search backend for all languages. The languages
+    are indexed serially, inside the test transaction.
+    """
+    if connection.vendor != 'postgresql':
+        pytest.skip("The PostgreSQL search backend needs a PostgreSQL database")
+    conf = {'default': {'ENGINE': 'multilingual_haystack.backends.MultilingualSearchEngine',
+                        'INDEX_WORKERS': 1}}
+    for lang, _ in settings.LANGUAGES:
+        conf['default-%s' % lang] = {
+            'ENGINE': 'multilingual_haystack.backends.LanguageSearchEngine',
+            'BASE_ENGINE': 'multilingual_haystack.postgres_backend.PostgresSearchEngine',
+        }
+    settings.HAYSTACK_CONNECTIONS = conf
+    monkeypatch.setattr(haystack_connections, 'connections_info', conf)
+    monkeypatch.setattr(haystack_connections, '_connections', {})
+    search_cache.entries.clear()
+    return haystack_connections
+
+
+@pytest.fixture
+def search_units(postgres_search, service_tree):
+    """
+    Index three units and a service:
+    1 'Uimahalli' in Helsinki, root services 1, in the centre of Helsinki
+    2 'Uimahalli Länsi' in Espoo, root services 1 and 4, about 16 km west
+    3 'Kirjasto' in Helsinki, root services 4, no location, keyword 'sauna'
+    5 the service 'Uimahalli'
+    """
+    helsinki = Municipality.objects.create(id='helsinki', name='Helsinki')
+    espoo = Municipality.objects.create(id='espoo', name='Espoo')
+    org = Organization.objects.create(id=1, name='org', data_source_url='http://example.com')
+    specs = [
+        (1, 'Uimahalli', helsinki, '1', Point(24.94, 60.17, srid=4326)),
+        (2, 'Uimahalli Länsi', espoo, '1,4', Point(24.65, 60.20, srid=4326)),
+        (3, 'Kirjasto', helsinki, '4', None),
+    ]
+    units = {}
+    for unit_id, name, muni, root_services, location in specs:
+        units[unit_id] = Unit.objects.create(
+            id=unit_id, name=name, provider_type=1, organization=org, municipality=muni,
+            root_services=root_services, location=location,
+            origin_last_modified_time=d.datetime.now())
+    units[3].keywords.add(Keyword.objects.create(language='fi', name='sauna'))
+    Service.objects.create(id=5, name='Uimahalli', unit_count=0, last_modified_time=d.datetime.now())
+
+    backend = postgres_search['default'].get_backend()
+    unified_index = postgres_search['default'].get_unified_index()
+    for model in (Unit, Service):
+        index = unified_index.get_index(model)
+        backend.update(index, index.index_queryset())
+    return units
@@ -0,0 +1,57 @@
+import pytest
+import datetime as d
+
+from services import autosuggest
+from services.models import Keyword, Organization, Service, Unit
+
+
+@pytest.fixture
+def fresh_index(monkeypatch):
+    monkeypatch.setattr(autosuggest, '_index', None)
+    monkeypatch.setattr(autosuggest, 'CHECK_INTERVAL', 0)
+
+
+@pytest.fixture
+def pools(service_tree):
+    org = Organization.objects.create(id=1, name='org', data_source_url='http://example.com')
+    Service.objects.create(id=10, name='uimahallit', unit_count=0, last_modified_time=d.datetime.now())
+    for unit_id, name in ((1, 'Itäkeskuksen uimahalli'), (2, 'Uimahalli')):
+        Unit.objects.create(id=unit_id, name=name, provider_type=1, organization=org,
+                            origin_last_modified_time=d.datetime.now())
+    kw = Keyword.objects.create(language='fi', name='uinti')
+    Unit.objects.get(id=1).keywords.add(kw)
+
+
+@pytest.mark.django_db
+def test__prefix_matches_ranked_by_score(pools, fresh_index):
+    results = autosuggest.get_autosuggest_index().suggest('fi', 'Uima')
+    assert [(r.model_name, int(r.pk)) for r in results] == [('unit', 2), ('service', 10), ('unit', 1)]
+
+    results = autosuggest.get_autosuggest_index().suggest('fi', 'uimahalli')
+    # The exact name match gets the autosuggest_exact boost
+    assert (results[0].model_name, results[0].score) == ('unit', 1.0 + autosuggest.EXACT_BOOST)
+
+
+@pytest.mark.django_db
+def test__keyword_and_model_filter(pools, fresh_index):
+    results = autosuggest.get_autosuggest_index().suggest('fi', 'uin', models=[Unit])
+    assert [int(r.pk) for r in results] == [1]
+
+
+@pytest.mark.django_db
+def test__falls_back_for_multiword_and_unknown_input(pools, fresh_index):
+    index = autosuggest.get_autosuggest_index()
+    assert index.suggest('fi', 'uima halli') is None
+    assert index.suggest('fi', 'xyzzy') is None
+
+
+@pytest.mark.django_db
+def test__index_is_rebuilt_after_max_age(pools, fresh_index, monkeypatch):
+    index = autosuggest.get_autosuggest_index()
+    Service.objects.create(id=11, name='uimarannat', unit_count=0, last_modified_time=d.datetime.now())
+    # The generation is unchanged, e.g. after a plain update_index run
+    assert autosuggest.get_autosuggest_index() is index
+
+    monkeypatch.setattr(autosuggest, 'MAX_AGE', 0)
+    results = autosuggest.get_autosuggest_index().suggest('fi', 'uimara')
+    assert [int(r.pk) for r in results] == [11]
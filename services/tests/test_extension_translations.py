@@ -0,0 +1,23 @@
+from django.test import override_settings
+from django.utils import translation
+
+from services.extension_translations import get_extension_translations, LANGUAGES
+
+
+def test__translations_match_override():
+    table = get_extension_translations()
+    for value in ('_illuminated', '_classic/free', 'untranslated value', ''):
+        expected = {}
+        for lang in LANGUAGES:
+            with translation.override(lang):
+                translated = translation.ugettext(value)
+            if translated != value:
+                expected[lang] = translated
+        assert table.translate(value) == expected
+
+
+def test__table_is_reloaded_with_catalogs():
+    table = get_extension_translations()
+    assert get_extension_translations() is table
+    with override_settings(LOCALE_PATHS=[]):
+        assert get_extension_translations() is not table
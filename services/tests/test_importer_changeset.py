@@ -0,0 +1,17 @@
+from services.importer.changeset import Changeset
+
+
+def test__changeset_roundtrip(tmpdir):
+    changeset = Changeset()
+    changeset.add('services.unit', 'created', 1)
+    changeset.add_many('services.unit', 'changed', [2, 3, 2])
+    changeset.add('services.service', 'deleted', 10)
+    path = str(tmpdir.join('changeset.json'))
+    changeset.save(path)
+
+    loaded = Changeset.load(path)
+    assert loaded.labels() == ['services.service', 'services.unit']
+    assert loaded.get('services.unit', 'changed') == set([2, 3])
+    assert loaded.get('services.service', 'deleted') == set([10])
+    assert loaded.get('services.service', 'created') == set()
+    assert loaded.count() == 4
@@ -0,0 +1,63 @@
+import time
+
+import pytest
+import requests
+from services.importer.http import PalvelukarttaClient
+
+
+UNITS = [{'id': 1, 'name_fi': 'Yksi'}, {'id': 2, 'name_fi': 'Kaksi'}]
+
+
+def make_client(server, **kwargs):
+    kwargs.setdefault('backoff_factor', 0)
+    return PalvelukarttaClient(server.base_url, **kwargs)
+
+
+def test__get_and_stream(palvelukartta_server):
+    palvelukartta_server.resources['unit/'] = UNITS
+    palvelukartta_server.resources['unit/2/'] = UNITS[1]
+    client = make_client(palvelukartta_server)
+    assert client.get('unit') == UNITS
+    assert client.get('unit', 2) == UNITS[1]
+    assert list(client.stream('unit')) == UNITS
+    assert client.timings['unit'][0] == 3
+
+
+def test__stream_timing_excludes_processing(palvelukartta_server):
+    palvelukartta_server.resources['unit/'] = UNITS
+    client = make_client(palvelukartta_server)
+    for obj in client.stream('unit'):
+        time.sleep(0.2)
+    count, total = client.timings['unit']
+    assert count == 1
+    assert total < 0.2
+
+
+def test__parallel_fetch(palvelukartta_server):
+    palvelukartta_server.resources['unit/'] = UNITS
+    palvelukartta_server.resources['connection/'] = []
+    for unit in UNITS:
+        palvelukartta_server.resources['unit/%d/' % unit['id']] = unit
+    client = make_client(palvelukartta_server, concurrency=4)
+
+    results = client.run_parallel({
+        'unit': lambda: client.get('unit'),
+        'connection': lambda: client.get('connection'),
+    })
+    assert results == {'unit': UNITS, 'connection': []}
+    assert client.get_many('unit', [2, 1]) == [UNITS[1], UNITS[0]]
+
+
+def test__retry_on_server_error(palvelukartta_server):
+    palvelukartta_server.resources['unit/'] = UNITS
+    palvelukartta_server.failures['unit/'] = 2
+    client = make_client(palvelukartta_server, retries=3)
+    assert client.get('unit') == UNITS
+    assert palvelukartta_server.requests.count('unit/') == 3
+
+
+def test__retries_exhausted(palvelukartta_server):
+    palvelukartta_server.failures['unit/'] = 10
+    client = make_client(palvelukartta_server, retries=1)
+    with pytest.raises(requests.RequestException):
+        client.get('unit')
@@ -0,0 +1,79 @@
+import pytest
+import datetime as d
+
+from services.importer.changeset import Changeset
+from services.importer.http import PalvelukarttaClient
+from services.management.commands import services_import
+from services.models import DataGeneration, Organization, Service, ServiceClosure, Unit
+from services.service_tree import SERVICE_TREE_GENERATION
+
+SERVICES = [
+    {'id': 1, 'name_fi': 'Juuri', 'child_ids': [2]},
+    {'id': 2, 'name_fi': 'Lapsi', 'parent_id': 1, 'child_ids': []},
+]
+UNITS = [{'id': 10, 'service_ids': [2]}]
+
+
+def run_import(command, **kwargs):
+    parser = command.create_parser('', 'services_import')
+    defaults, _ = parser.parse_args(args=[])
+    options = dict(defaults.__dict__, verbosity=0, skip_checks=True, **kwargs)
+    command.execute(**options)
+
+
+@pytest.mark.django_db
+def test__service_tree_is_rebuilt_only_on_changes(palvelukartta_server, monkeypatch):
+    palvelukartta_server.resources['service/'] = SERVICES
+    palvelukartta_server.resources['unit/'] = UNITS
+    monkeypatch.setattr(services_import, 'URL_BASE', palvelukartta_server.base_url)
+    command = services_import.Command()
+
+    run_import(command, services=True)
+    generation = DataGeneration.objects.current(SERVICE_TREE_GENERATION)
+    assert generation > 0
+    assert ServiceClosure.objects.filter(ancestor=1, descendant=2).exists()
+
+    run_import(command, services=True)
+    assert DataGeneration.objects.current(SERVICE_TREE_GENERATION) == generation
+
+    palvelukartta_server.resources['service/'] = SERVICES[:1]
+    run_import(command, services=True)
+    assert not Service.objects.filter(id=2).exists()
+    assert DataGeneration.objects.current(SERVICE_TREE_GENERATION) == generation + 1
+
+
+@pytest.mark.django_db
+def test__root_services_update_moves_modified_time(service_tree):
+    org = Organization.objects.create(id=1, name='org', data_source_url='http://example.com')
+    old_time = d.datetime(2016, 1, 1, tzinfo=d.timezone.utc)
+    for unit_id in (1, 2):
+        unit = Unit.objects.create(id=unit_id, name='unit', provider_type=1, organization=org,
+                                   origin_last_modified_time=old_time)
+        unit.services.add(service_tree['grandchild'])
+    Unit.objects.filter(id=2).update(root_services='1')
+
+    command = services_import.Command()
+    command.verbosity = 0
+    command.changeset = Changeset()
+    command.update_root_services()
+
+    units = {unit.id: unit for unit in Unit.objects.all()}
+    assert units[1].root_services == '1'
+    assert units[1].origin_last_modified_time > old_time
+    # Units whose root services stay the same are left alone
+    assert units[2].origin_last_modified_time == old_time
+    assert command.changeset.get('services.unit', 'changed') == {1}
+
+
+def test__unit_services_stream_is_reused_for_the_unit_import(palvelukartta_server):
+    palvelukartta_server.resources['unit/'] = UNITS
+    command = services_import.Command()
+    command.options = {'units': True, 'single': None}
+    command.verbosity = 0
+    command.prefetched = {}
+    command.spooled = {}
+    command.http = PalvelukarttaClient(palvelukartta_server.base_url)
+
+    assert list(command._fetch_unit_services()) == [(10, [2])]
+    assert list(command.pk_stream('unit')) == UNITS
+    assert palvelukartta_server.requests.count('unit/') == 1
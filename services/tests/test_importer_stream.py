@@ -0,0 +1,43 @@
+import json
+import pytest
+from services.importer.stream import iter_json_array, iter_chunks, iter_queryset_chunks
+from services.models import Service
+
+
+def split(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def test__iter_json_array_across_chunk_boundaries():
+    objs = [{'id': i, 'name_fi': 'Yksikkö %d' % i, 'service_ids': [i, i + 1]} for i in range(100)]
+    objs += [42, 'text', None]
+    data = json.dumps(objs, ensure_ascii=False).encode('utf8')
+    for size in (1, 2, 5, 64, len(data)):
+        assert list(iter_json_array(split(data, size))) == objs
+
+
+def test__iter_json_array_numbers_across_chunk_boundaries():
+    objs = [1, 2.5, -3.25, 1e5, 2.5E-3, -7e+2, 10, 0.125, 123456789]
+    data = json.dumps(objs).encode('utf8')
+    for size in (1, 2, 3, 4, len(data)):
+        assert list(iter_json_array(split(data, size))) == objs
+    assert list(iter_json_array([b'[1, 2.', b'5, 3', b'e2]'])) == [1, 2.5, 300.0]
+
+
+def test__iter_json_array_rejects_garbage_after_value():
+    with pytest.raises(ValueError):
+        list(iter_json_array([b'[1x]']))
+
+
+def test__iter_json_array_empty():
+    assert list(iter_json_array([b' [', b' ]\n'])) == []
+
+
+def test__iter_chunks():
+    assert list(iter_chunks(range(5), 2)) == [[0, 1], [2, 3], [4]]
+
+
+@pytest.mark.django_db
+def test__iter_queryset_chunks_pages_by_pk(service_tree):
+    chunks = list(iter_queryset_chunks(Service.objects.all(), 3))
+    assert [[obj.id for obj in chunk] for chunk in chunks] == [[1, 2, 3], [4]]
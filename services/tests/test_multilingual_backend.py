@@ -0,0 +1,52 @@
+import time
+
+from django.utils import translation
+from haystack import indexes
+
+from multilingual_haystack import backends
+
+
+class LanguageIndex(indexes.SearchIndex):
+    text = indexes.CharField(document=True)
+
+    def prepare(self, obj):
+        # Like SearchIndex.prepare(), build the document on the instance
+        self.prepared_data = {}
+        time.sleep(0.001)
+        self.prepared_data['text'] = '%s %s' % (obj, translation.get_language())
+        return self.prepared_data
+
+
+class RecordingBackend(object):
+    def __init__(self, language, documents):
+        self.language = language
+        self.documents = documents
+        self.parent_class = self
+
+    def update(self, backend, index, iterable, *args, **kwargs):
+        docs = [index.prepare(obj)['text'] for obj in iterable]
+        self.documents[self.language] = docs
+
+
+class FakeConnection(object):
+    def __init__(self, backend):
+        self.backend = backend
+
+    def get_backend(self):
+        return self.backend
+
+
+def test__languages_prepare_documents_concurrently(monkeypatch, settings):
+    settings.LANGUAGES = (('fi', 'Finnish'), ('sv', 'Swedish'), ('en', 'English'))
+    documents = {}
+    fake_connections = {'default-%s' % lang: FakeConnection(RecordingBackend(lang, documents))
+                        for lang, _ in settings.LANGUAGES}
+    monkeypatch.setattr(backends, 'connections', fake_connections)
+
+    backend = backends.MultilingualSearchBackend('default', INDEX_WORKERS=3)
+    objs = ['unit %d' % i for i in range(50)]
+    backend.update(LanguageIndex(), objs)
+
+    assert sorted(documents) == ['en', 'fi', 'sv']
+    for lang, docs in documents.items():
+        assert docs == ['%s %s' % (obj, lang) for obj in objs]
@@ -0,0 +1,129 @@
+import pytest
+from django.contrib.gis.geos import Point
+from django.contrib.gis.measure import D
+from django.utils import translation
+from haystack.exceptions import SearchBackendError
+from haystack.inputs import AutoQuery
+from haystack.query import SearchQuerySet
+
+from multilingual_haystack.custom_elasticsearch_search_backend import CustomEsSearchQuerySet
+
+from multilingual_haystack.postgres_backend import PostgresSearchBackend, parse_distance, parse_geo_point
+from services.models import Unit
+
+
+def test__parse_distance():
+    assert parse_distance('5km') == 5000
+    assert parse_distance('250 m') == 250
+    assert parse_distance(100) == 100
+    with pytest.raises(ValueError):
+        parse_distance('5 miles')
+
+
+def test__parse_geo_point():
+    expected = (24.94, 60.17)
+    assert parse_geo_point('60.17,24.94') == expected
+    assert parse_geo_point({'lat': 60.17, 'lon': 24.94}) == expected
+    assert parse_geo_point([24.94, 60.17]) == expected
+
+
+class FakeField(object):
+    def __init__(self, field_type, document=False, is_multivalued=False):
+        self.field_type = field_type
+        self.document = document
+        self.is_multivalued = is_multivalued
+
+
+class FakeIndex(object):
+    def full_prepare(self, obj):
+        return obj
+
+
+def test__build_row_indexes_multivalued_text():
+    backend = PostgresSearchBackend('default-fi')
+    backend.get_fields = lambda: {
+        'text': FakeField('string', document=True),
+        'extra_searchwords': FakeField('string', is_multivalued=True),
+        'services': FakeField('integer', is_multivalued=True),
+    }
+    doc = {'id': 'services.unit.1', 'django_ct': 'services.unit', 'django_id': 1,
+           'text': 'Uimahalli', 'extra_searchwords': ['uinti', 'sauna'], 'services': [1, 2]}
+    row = backend._build_row(FakeIndex(), doc)
+    assert row[5] == 'Uimahalli'
+    assert row[7] == 'uinti sauna'
+
+
+def test__search_rejects_unsupported_queries():
+    backend = PostgresSearchBackend('default-fi')
+    with pytest.raises(SearchBackendError):
+        backend.search('raw query')
+    with pytest.raises(SearchBackendError):
+        backend.search({'where': 'TRUE', 'params': []}, narrow_queries={'name:foo'})
+
+
+def unit_ids(queryset):
+    return [int(result.pk) for result in queryset]
+
+
+@pytest.fixture
+def fi():
+    with translation.override('fi'):
+        yield
+
+
+@pytest.mark.django_db
+def test__search_text_and_extra_searchwords(search_units, fi):
+    sqs = SearchQuerySet().models(Unit)
+    assert sorted(unit_ids(sqs.filter(text=AutoQuery('uimahalli')))) == [1, 2]
+    assert unit_ids(sqs.filter(extra_searchwords='sauna')) == [3]
+    assert unit_ids(sqs.filter(autosuggest='kirj')) == [3]
+    assert sqs.filter(text=AutoQuery('uimahalli')).count() == 2
+
+
+@pytest.mark.django_db
+def test__search_location_filters(search_units, fi):
+    sqs = SearchQuerySet().models(Unit)
+    centre = Point(24.94, 60.17, srid=4326)
+    assert unit_ids(sqs.dwithin('location', centre, D(m=1000))) == [1]
+    assert unit_ids(sqs.within('location', Point(24.6, 60.1, srid=4326),
+                               Point(24.7, 60.3, srid=4326))) == [2]
+
+
+@pytest.mark.django_db
+def test__search_facets(search_units, fi):
+    sqs = SearchQuerySet().filter(text=AutoQuery('uimahalli'))
+    sqs = sqs.facet('django_ct').facet('municipality').facet('root_services')
+    fields = sqs.facet_counts()['fields']
+    assert fields['django_ct'] == [('services.unit', 2), ('services.service', 1)]
+    assert fields['municipality_exact'] == [('espoo', 1), ('helsinki', 1)]
+    assert fields['root_services_exact'] == [('1', 2), ('4', 1)]
+
+
+@pytest.mark.django_db
+def test__search_ordering(search_units, fi):
+    sqs = SearchQuerySet().models(Unit)
+    assert unit_ids(sqs.order_by('autosuggest_exact')) == [3, 1, 2]
+    assert unit_ids(sqs.order_by('-autosuggest_exact')) == [2, 1, 3]
+    with pytest.raises(SearchBackendError):
+        list(sqs.order_by("name'); DROP TABLE services_unit; --"))
+    with pytest.raises(SearchBackendError):
+        sqs.facet('no_such_field').facet_counts()
+
+
+@pytest.mark.django_db
+def test__search_distance_decay(search_units, fi):
+    sqs = CustomEsSearchQuerySet().models(Unit).filter(text=AutoQuery('uimahalli'))
+    decayed = sqs.decay({'gauss': {'location': {'origin': '60.20,24.65', 'scale': '2km'}}})
+    results = list(decayed)
+    assert unit_ids(results) == [2, 1]
+    assert results[0].score > results[1].score
+    with pytest.raises(SearchBackendError):
+        list(sqs.decay({'gauss': {'autosuggest_exact': {'origin': '60.20,24.65', 'scale': '2km'}}}))
+
+
+@pytest.mark.django_db
+def test__more_like_this(search_units, fi):
+    sqs = SearchQuerySet().models(Unit)
+    # Unit 2 shares the name and unit 3 the municipality, not itself
+    assert sorted(unit_ids(sqs.more_like_this(search_units[1]))) == [2, 3]
+    assert unit_ids(sqs.filter(municipality='espoo').more_like_this(search_units[1])) == [2]
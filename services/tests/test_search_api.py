@@ -0,0 +1,46 @@
+import pytest
+from rest_framework.test import APIClient
+
+from services.search_cache import search_cache
+
+
+@pytest.fixture
+def client():
+    search_cache.entries.clear()
+    return APIClient()
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('params', ['lat=60.17&lon=24.94', 'lat=60.17&lon=24.94&distance=500',
+                                    'bbox=24.9,60.1,25.0,60.2&bbox_srid=4326'])
+def test__location_filters_rejected_by_simple_backend(client, params):
+    response = client.get('/v1/search/?q=uimahalli&%s' % params)
+    assert response.status_code == 400
+
+
+@pytest.mark.django_db
+def test__facet_counts_cover_all_results(search_units, client):
+    response = client.get('/v1/search/?q=uimahalli&page_size=1&facets=type,municipality,root_services')
+    assert response.status_code == 200
+    assert response.data['count'] == 3
+    assert len(response.data['results']) == 1
+    facets = response.data['facets']
+    assert list(facets.keys()) == ['type', 'municipality', 'root_services']
+    assert dict(facets['type']) == {'unit': 2, 'service': 1}
+    assert dict(facets['municipality']) == {'espoo': 1, 'helsinki': 1}
+    assert dict(facets['root_services']) == {'1': 2, '4': 1}
+
+
+@pytest.mark.django_db
+def test__facet_counts_follow_filters(search_units, client):
+    response = client.get('/v1/search/?q=uimahalli&type=unit&municipality=helsinki'
+                          '&facets=municipality,root_services')
+    assert response.status_code == 200
+    assert dict(response.data['facets']['municipality']) == {'helsinki': 1}
+    assert dict(response.data['facets']['root_services']) == {'1': 1}
+
+
+@pytest.mark.django_db
+def test__invalid_facet(client):
+    response = client.get('/v1/search/?q=uimahalli&facets=type,color')
+    assert response.status_code == 400
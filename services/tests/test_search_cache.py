@@ -0,0 +1,22 @@
+from django.http import QueryDict
+
+from services.search_cache import SearchResponseCache, normalize_params
+
+
+def test__normalize_params():
+    params = normalize_params(QueryDict('input=  Uima  Halli&type=unit,service&callback=x'), 'fi')
+    assert params == {'input': 'uima halli', 'type': 'service,unit', 'language': 'fi'}
+
+
+def test__lru_eviction_and_counters():
+    cache = SearchResponseCache(size=2, timeout=60, alias=None)
+    cache.set('a', {'count': 1})
+    cache.set('b', {'count': 2})
+    assert cache.get('a') == {'count': 1}
+    cache.set('c', {'count': 3})
+    # 'b' was the least recently used entry
+    assert cache.get('b') is None
+    assert cache.get('c') == {'count': 3}
+
+    stats = cache.get_stats()
+    assert (stats['size'], stats['hits'], stats['misses']) == (2, 2, 1)
@@ -0,0 +1,48 @@
+import pytest
+import datetime as d
+from django.contrib.gis.geos import Point
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import translation
+from haystack import connections
+
+from services.models import Keyword, Organization, Unit
+
+
+@pytest.fixture
+def indexed_units(service_tree):
+    org = Organization.objects.create(id=1, name='org', data_source_url='http://example.com')
+    keywords = [Keyword.objects.create(language=lang, name='kw %s' % lang) for lang in ('fi', 'sv')]
+    for unit_id in range(1, 6):
+        unit = Unit.objects.create(
+            id=unit_id, name='unit %d' % unit_id, provider_type=1, organization=org,
+            origin_last_modified_time=d.datetime.now())
+        unit.services.add(service_tree['child'], service_tree['other_root'])
+        unit.keywords.add(*keywords)
+
+
+def prepare_all(model):
+    index = connections['default'].get_unified_index().get_index(model)
+    with CaptureQueriesContext(connection) as queries:
+        docs = [index.full_prepare(obj) for obj in index.build_queryset()]
+    return docs, len(queries)
+
+
+@pytest.mark.django_db
+def test__unit_index_prepare_uses_prefetched_data(indexed_units):
+    with translation.override('fi'):
+        docs, query_count = prepare_all(Unit)
+    assert len(docs) == 5
+    assert docs[0]['extra_searchwords'] == 'kw fi'
+    assert sorted(docs[0]['services']) == [2, 4]
+    # Units, keywords and services, regardless of the number of units
+    assert query_count == 3
+
+
+def test__unit_location_prepared_in_wgs84():
+    index = connections['default'].get_unified_index().get_index(Unit)
+    point = Point(385000, 6672000, srid=3067)
+    expected = point.transform(4326, clone=True)
+    lat, lon = [float(x) for x in index.prepare_location(Unit(location=point)).split(',')]
+    assert (round(lat, 6), round(lon, 6)) == (round(expected.y, 6), round(expected.x, 6))
+    assert index.prepare_location(Unit(location=None)) is None
@@ -0,0 +1,37 @@
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from haystack.models import SearchResult
+from rest_framework.exceptions import ParseError
+
+from services.api import SearchSerializer
+
+
+@pytest.mark.django_db
+def test__search_results_hydrated_in_one_query_per_model(service_tree):
+    results = [SearchResult('services', 'service', pk, score)
+               for pk, score in (('3', 2.0), ('999', 1.5), ('1', 1.0))]
+    context = {'only': {'service': ['name']}}
+    with CaptureQueriesContext(connection) as queries:
+        data = SearchSerializer(results, many=True, context=context).data
+    assert len(queries) == 1
+    # The missing service is left out and the search order is kept
+    assert [(x['id'], x['score']) for x in data] == [(3, 2.0), (1, 1.0)]
+    assert all(x['object_type'] == 'service' for x in data)
+    assert results[0]._object.id == 3
+
+
+@pytest.mark.django_db
+def test__search_results_reject_unknown_unit_include():
+    results = [SearchResult('services', 'unit', '1', 1.0)]
+    context = {'include': {'unit': ['name']}}
+    with pytest.raises(ParseError):
+        SearchSerializer(results, many=True, context=context).data
+
+
+@pytest.mark.django_db
+def test__search_results_reject_unknown_unit_only():
+    results = [SearchResult('services', 'unit', '1', 1.0)]
+    context = {'only': {'unit': ['no_such_field']}}
+    with pytest.raises(ParseError):
+        SearchSerializer(results, many=True, context=context).data
@@ -0,0 +1,24 @@
+import pytest
+from services.models import Service, ServiceClosure
+
+
+@pytest.mark.django_db
+def test__closure_contains_self_links_and_depths(service_tree):
+    links = set(ServiceClosure.objects.values_list('ancestor_id', 'descendant_id', 'depth'))
+    assert links == set([
+        (1, 1, 0), (1, 2, 1), (1, 3, 2),
+        (2, 2, 0), (2, 3, 1),
+        (3, 3, 0),
+        (4, 4, 0)])
+
+
+@pytest.mark.django_db
+def test__by_ancestor(service_tree):
+    ids = set(Service.objects.by_ancestor(service_tree['root']).values_list('id', flat=True))
+    assert ids == set([2, 3])
+
+
+@pytest.mark.django_db
+def test__by_ancestors_include_self(service_tree):
+    qs = Service.objects.by_ancestors([2, 4], include_self=True)
+    assert set(qs.values_list('id', flat=True)) == set([2, 3, 4])
@@ -0,0 +1,29 @@
+import pytest
+from services.models import DataGeneration
+from services import service_tree as tree_module
+
+
+@pytest.fixture
+def fresh_snapshot(monkeypatch):
+    monkeypatch.setattr(tree_module, '_snapshot', None)
+    monkeypatch.setattr(tree_module, 'CHECK_INTERVAL', 0)
+
+
+@pytest.mark.django_db
+def test__snapshot_roots_and_levels(service_tree, fresh_snapshot):
+    tree = tree_module.get_service_tree()
+    assert tree.root_id(3) == 1
+    assert tree.root_id(4) == 4
+    assert tree.get(3).level == 2
+    assert tree.get(2).parent_id == 1
+
+
+@pytest.mark.django_db
+def test__snapshot_reloaded_on_generation_bump(service_tree, fresh_snapshot):
+    tree = tree_module.get_service_tree()
+    assert tree_module.get_service_tree() is tree
+
+    DataGeneration.objects.bump(tree_module.SERVICE_TREE_GENERATION)
+    new_tree = tree_module.get_service_tree()
+    assert new_tree is not tree
+    assert new_tree.generation == tree.generation + 1
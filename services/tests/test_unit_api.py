@@ -0,0 +1,202 @@
+import gzip
+import json
+from xml.etree import ElementTree
+
+import pytest
+import datetime as d
+from django.contrib.gis.geos import Point
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+
+from services.api import UnitSerializer, UnitViewSet
+from services.models import Organization, Unit
+from services.unit_cache import unit_cache
+
+
+@pytest.fixture
+def units():
+    org = Organization.objects.create(id=1, name='org', data_source_url='http://example.com')
+    for unit_id in (5, 1, 3, 2, 4):
+        Unit.objects.create(id=unit_id, name='unit %d' % unit_id, provider_type=1, organization=org,
+                            origin_last_modified_time=d.datetime.now())
+
+
+@pytest.mark.django_db
+def test__cursor_pagination_walks_all_units(units):
+    client = APIClient()
+    url = '/v1/unit/?pagination=cursor&page_size=2&only=name'
+    ids = []
+    while url:
+        data = client.get(url).data
+        assert 'count' not in data
+        ids += [x['id'] for x in data['results']]
+        url = data['next']
+    assert ids == [1, 2, 3, 4, 5]
+
+
+@pytest.mark.django_db
+def test__invalid_cursor(units):
+    response = APIClient().get('/v1/unit/?cursor=garbage')
+    assert response.status_code == 404
+
+
+@pytest.mark.django_db
+def test__geojson_export_streams_all_units(units):
+    response = APIClient().get('/v1/unit/export/?file_format=geojson&only=name,location')
+    assert response.streaming
+    data = json.loads(b''.join(response.streaming_content).decode('utf8'))
+    assert data['type'] == 'FeatureCollection'
+    assert [f['id'] for f in data['features']] == [1, 2, 3, 4, 5]
+
+
+@pytest.mark.django_db
+def test__kml_export_streams_all_units(units):
+    response = APIClient().get('/v1/unit/export/?file_format=kml&language=fi')
+    assert response.streaming
+    assert response['Content-Disposition'] == 'attachment; filename=palvelukartta.kml'
+    root = ElementTree.fromstring(b''.join(response.streaming_content))
+    placemarks = root.findall('.//{http://www.opengis.net/kml/2.2}Placemark')
+    assert [p.get('id') for p in placemarks] == ['1', '2', '3', '4', '5']
+    assert placemarks[0].find('{http://www.opengis.net/kml/2.2}name').text == 'unit 1'
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('query, headers', [
+    ('&compress=gzip', {}),
+    ('', {'HTTP_ACCEPT_ENCODING': 'gzip, deflate'}),
+])
+def test__export_gzip(units, query, headers):
+    response = APIClient().get('/v1/unit/export/?file_format=geojson' + query, **headers)
+    assert response['Content-Encoding'] == 'gzip'
+    data = json.loads(gzip.decompress(b''.join(response.streaming_content)).decode('utf8'))
+    assert [f['id'] for f in data['features']] == [1, 2, 3, 4, 5]
+
+
+@pytest.mark.django_db
+def test__export_invalid_compress(units):
+    assert APIClient().get('/v1/unit/export/?compress=zip').status_code == 400
+
+
+@pytest.mark.django_db
+def test__serialization_plan_matches_generic_serializer(units, settings):
+    settings.UNIT_FRAGMENT_CACHE = False
+    for query in ('', '?only=name,location&geometry=true', '?include=services'):
+        plan_data = APIClient().get('/v1/unit/' + query).data['results']
+        UnitSerializer.use_plan = False
+        try:
+            generic_data = APIClient().get('/v1/unit/' + query).data['results']
+        finally:
+            UnitSerializer.use_plan = True
+        assert json.dumps(plan_data) == json.dumps(generic_data)
+
+
+@pytest.mark.django_db
+def test__values_plan_matches_serializer(units):
+    Unit.objects.filter(id=1).update(location=Point(24.94, 60.17, srid=4326),
+                                     extensions={'lighting': '_illuminated'},
+                                     root_services='1,2')
+    queries = ('id,name,location', 'name,street_address,origin_last_modified_time',
+               'organization,municipality,extensions,root_services,data_source')
+    for only in queries:
+        url = '/v1/unit/?only=%s&srid=4326' % only
+        values_data = APIClient().get(url).data['results']
+        UnitViewSet.use_values_plan = False
+        try:
+            object_data = APIClient().get(url).data['results']
+        finally:
+            UnitViewSet.use_values_plan = True
+        assert json.dumps(values_data) == json.dumps(object_data)
+
+
+@pytest.mark.django_db
+def test__fragment_cache_follows_unit_modification(units):
+    unit_cache.clear()
+    client = APIClient()
+    assert client.get('/v1/unit/1/').data['name']['fi'] == 'unit 1'
+    hits = unit_cache.hits
+    assert client.get('/v1/unit/1/').data['name']['fi'] == 'unit 1'
+    assert unit_cache.hits == hits + 1
+
+    # The importer moves origin_last_modified_time when it changes a unit
+    Unit.objects.filter(id=1).update(name_fi='renamed',
+                                     origin_last_modified_time=d.datetime.now())
+    assert client.get('/v1/unit/1/').data['name']['fi'] == 'renamed'
+    assert unit_cache.hits == hits + 1
+
+
+@pytest.mark.django_db
+def test__conditional_get_on_unit_list(units):
+    client = APIClient()
+    response = client.get('/v1/unit/?only=name')
+    assert response.status_code == 200
+    etag = response['ETag']
+
+    response = client.get('/v1/unit/?only=name', HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 304
+    assert response['ETag'] == etag
+    response = client.get('/v1/unit/?only=name',
+                          HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+    assert response.status_code == 304
+
+    Unit.objects.filter(id=3).update(origin_last_modified_time=d.datetime.now() + d.timedelta(days=1))
+    response = client.get('/v1/unit/?only=name', HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+    assert response['ETag'] != etag
+
+    # Deleting a unit changes the list even if the newest unit stays
+    etag = response['ETag']
+    Unit.objects.filter(id=1).delete()
+    assert client.get('/v1/unit/?only=name', HTTP_IF_NONE_MATCH=etag).status_code == 200
+
+
+@pytest.mark.django_db
+def test__conditional_get_notices_changes_on_other_pages(units):
+    client = APIClient()
+    url = '/v1/unit/?only=name&page_size=2'
+    etag = client.get(url)['ETag']
+    # The first page keeps its units, but count and next change
+    Unit.objects.filter(id=5).delete()
+    response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+    assert response.data['count'] == 4
+
+    # The last keyset page keeps its units but gets a next page
+    response = client.get('/v1/unit/?only=name&page_size=2&pagination=cursor')
+    last_page_url = response.data['next']
+    response = client.get(last_page_url)
+    assert response.data['next'] is None
+    etag = response['ETag']
+    Unit.objects.create(id=6, name='unit 6', provider_type=1, organization_id=1,
+                        origin_last_modified_time=d.datetime.now() - d.timedelta(days=1))
+    assert client.get(last_page_url, HTTP_IF_NONE_MATCH=etag).status_code == 200
+
+
+@pytest.mark.django_db
+def test__conditional_get_on_unit_detail(units):
+    client = APIClient()
+    etag = client.get('/v1/unit/2/')['ETag']
+    assert client.get('/v1/unit/2/', HTTP_IF_NONE_MATCH=etag).status_code == 304
+    assert client.get('/v1/unit/3/', HTTP_IF_NONE_MATCH=etag).status_code == 200
+
+
+@pytest.mark.django_db
+def test__cursor_pagination_with_only_fields(units):
+    client = APIClient()
+    url = '/v1/unit/?pagination=cursor&page_size=2&only=name,street_address'
+    pages = []
+    while url:
+        data = client.get(url).data
+        pages.append([(x['id'], x['name']['fi']) for x in data['results']])
+        url = data['next']
+    assert pages == [[(1, 'unit 1'), (2, 'unit 2')], [(3, 'unit 3'), (4, 'unit 4')], [(5, 'unit 5')]]
+
+
+@pytest.mark.django_db
+def test__validators_do_not_aggregate_the_queryset(units):
+    with CaptureQueriesContext(connection) as queries:
+        response = APIClient().get('/v1/unit/?pagination=cursor&only=name')
+    assert response.status_code == 200
+    assert response['ETag']
+    sql = ' '.join(q['sql'].upper() for q in queries)
+    assert 'COUNT(' not in sql and 'MAX(' not in sql
@@ -0,0 +1,175 @@
+"""
+Cache of serialized unit fragments.
+
+A unit's serialized data only changes when the importer touches the unit
+(which moves origin_last_modified_time) or, for include=observations,
+when a new observation replaces one of the unit's latest observations.
+The unit endpoints therefore cache the data of each unit under its id,
+the version of the unit and a digest of everything about the request
+that affects the output (fields, include=, geometry=, srid and the
+languages). Each process keeps a bounded LRU of fragments; optionally
+they are also stored in a shared Django cache (UNIT_CACHE_ALIAS).
+"""
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Max
+from rest_framework.utils.encoders import JSONEncoder
+
+from services.models import Unit
+from services.service_tree import get_service_tree
+
+# Maximum number of fragments kept in each process
+CACHE_SIZE = getattr(settings, 'UNIT_CACHE_SIZE', 20000)
+# Seconds a fragment is kept in either tier. Bounds the staleness of
+# data that is not covered by the unit version, e.g. department names.
+CACHE_TIMEOUT = getattr(settings, 'UNIT_CACHE_TIMEOUT', 3600)
+# Django cache alias for the shared tier, None to disable it
+CACHE_ALIAS = getattr(settings, 'UNIT_CACHE_ALIAS', None)
+
+LANGUAGES = [x[0] for x in settings.LANGUAGES]
+
+
+def is_enabled():
+    return getattr(settings, 'UNIT_FRAGMENT_CACHE', False)
+
+
+def get_plan_digest(serializer):
+    """
+    Digest of the serializer configuration of the current request.
+    """
+    plan = serializer.plan
+    data = [
+        type(serializer).__name__,
+        sorted(serializer.fields.keys()) + sorted(serializer.geo_fields),
+        sorted(plan.include_fields),
+        plan.include_geometry,
+        plan.srs.srid,
+        LANGUAGES,
+        # Service names and roots come from the service tree
+        get_service_tree().generation,
+    ]
+    return hashlib.sha1(json.dumps(data).encode('utf8')).hexdigest()
+
+
+def get_observation_versions(unit_ids):
+    """
+    Return a dict of unit id -> id of the newest of the unit's latest
+    observations. Observation ids only grow, so this changes whenever
+    a latest observation is replaced.
+    """
+    qs = Unit.objects.filter(id__in=unit_ids).annotate(
+        observation_version=Max('latest_observations__observation'))
+    return dict(qs.values_list('id', 'observation_version'))
+
+
+class UnitFragmentCache(object):
+    def __init__(self, size=CACHE_SIZE, timeout=CACHE_TIMEOUT, alias=CACHE_ALIAS):
+        self.size = size
+        self.timeout = timeout
+        self.alias = alias
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def make_keys(self, units, serializer):
+        plan_digest = get_plan_digest(serializer)
+        if 'observations' in serializer.plan.include_fields:
+            observation_versions = get_observation_versions([unit.id for unit in units])
+        else:
+            observation_versions = {}
+        keys = []
+        for unit in units:
+            modified = unit.origin_last_modified_time
+            keys.append('unit:%s:%d:%s:%s' % (
+                plan_digest, unit.id, modified.isoformat() if modified else '',
+                observation_versions.get(unit.id) or 0))
+        return keys
+
+    def get_many(self, keys):
+        now = time.time()
+        found = {}
+        with self._lock:
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is None:
+                    continue
+                stored_at, data = entry
+                if now - stored_at < self.timeout:
+                    self.entries.move_to_end(key)
+                    found[key] = data
+                else:
+                    del self.entries[key]
+
+        missing = [key for key in keys if key not in found]
+        if self.alias and missing:
+            shared = caches[self.alias].get_many(missing)
+            self._store(shared, now)
+            found.update(shared)
+
+        with self._lock:
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def _store(self, fragments, now):
+        with self._lock:
+            for key, data in fragments.items():
+                self.entries[key] = (now, data)
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def set_many(self, fragments):
+        # Store plain JSON data, detached from the serializers
+        fragments = {key: json.loads(json.dumps(data, cls=JSONEncoder), object_pairs_hook=OrderedDict)
+                     for key, data in fragments.items()}
+        self._store(fragments, time.time())
+        if self.alias:
+            caches[self.alias].set_many(fragments, self.timeout)
+
+    def serialize(self, units, serializer):
+        """
+        Return the serialized data of `units` using cached fragments
+        where possible. The distance annotation varies per request and
+        is added to the fragments afterwards.
+        """
+        keys = self.make_keys(units, serializer)
+        found = self.get_many(keys)
+        new_fragments = {}
+        result = []
+        for unit, key in zip(units, keys):
+            data = found.get(key)
+            if data is None:
+                data = serializer.to_representation(unit)
+                data.pop('distance', None)
+                new_fragments[key] = data
+            data = OrderedDict(data)
+            distance = getattr(unit, 'distance', None)
+            if distance:
+                data['distance'] = distance.m
+            result.append(data)
+        if new_fragments:
+            self.set_many(new_fragments)
+        return result
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+    def get_stats(self):
+        with self._lock:
+            return OrderedDict([
+                ('size', len(self.entries)),
+                ('hits', self.hits),
+                ('misses', self.misses),
+            ])
+
+
+unit_cache = UnitFragmentCache()
@@ -176,6 +176,10 @@ HAYSTACK_CONNECTIONS = {
 
 HAYSTACK_LIMIT_TO_REGISTERED_MODELS = False
 HAYSTACK_SIGNAL_PROCESSOR = 'services.search_indexes.DeleteOnlySignalProcessor'
+# Answer single-word autosuggest queries from an in-memory prefix index
+SEARCH_AUTOSUGGEST_INDEX = True
+# Cache serialized units until the unit or its observations change
+UNIT_FRAGMENT_CACHE = True
 
 KML_TRANSLATABLE_FIELDS = ['name', 'street_address', 'www_url']
 KML_REGEXP = 'application/vnd.google-earth\.kml'